@@ -0,0 +1,70 @@
+"""Asyncio API for using prass inside services. Requires Python 3.5+."""
+import asyncio
+import codecs
+import functools
+import inspect
+
+from subs import AssParser, AssScript, EventsSection
+
+DEFAULT_LINES_PER_YIELD = 1000
+READ_CHUNK_SIZE = 64 * 1024
+
+
+async def read_script(reader, events_section_factory=EventsSection, lines_per_yield=DEFAULT_LINES_PER_YIELD):
+    """Parse ASS script from an async byte stream (anything with a coroutine read(n) method,
+    like asyncio.StreamReader or aiohttp request content), giving control back to the loop every few lines"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    parser = AssParser(events_section_factory)
+    pending = u''
+    parsed = 0
+    while True:
+        chunk = await reader.read(READ_CHUNK_SIZE)
+        lines = (pending + decoder.decode(chunk, final=not chunk)).split(u'\n')
+        pending = lines.pop()
+        for line in lines:
+            parser.parse_line(line)
+            parsed += 1
+            if parsed % lines_per_yield == 0:
+                await asyncio.sleep(0)
+        if not chunk:
+            break
+    if pending:
+        parser.parse_line(pending)
+    return AssScript(parser.sections)
+
+
+async def write_script(script, writer, lines_per_yield=DEFAULT_LINES_PER_YIELD):
+    """Serialize the script to an async writer in batches of lines.
+    Works both with writers having a sync write() and coroutine drain() like asyncio.StreamWriter
+    and with writers having a coroutine write() like aiohttp.StreamResponse"""
+    batch = []
+    for line in script.iter_ass_lines():
+        batch.append(line)
+        if len(batch) == lines_per_yield:
+            await _write(writer, batch)
+            batch = []
+    if batch:
+        await _write(writer, batch)
+
+
+async def _write(writer, lines):
+    lines.append(u'')
+    result = writer.write(u'\n'.join(lines).encode('utf-8'))
+    if inspect.isawaitable(result):
+        await result
+    if hasattr(writer, 'drain'):
+        await writer.drain()
+    else:
+        await asyncio.sleep(0)
+
+
+def _apply_transform(script, method, args, kwargs):
+    getattr(script, method)(*args, **kwargs)
+    return script
+
+
+async def run_transform(script, method, *args, executor=None, **kwargs):
+    """Run a CPU-heavy AssScript method like tpp or resample in an executor instead of the event loop.
+    With a process pool the script is transformed in a copy, so always use the returned script."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(_apply_transform, script, method, args, kwargs))
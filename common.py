@@ -1,3 +1,4 @@
+import os
 import sys
 
 from click.exceptions import ClickException
@@ -15,6 +16,7 @@ if not PY2:
     iterkeys = lambda x: iter(x.keys())
     zip = zip
     map = map
+    replace_file = os.replace
 else:
     itervalues = lambda x: x.itervalues()
     iteritems = lambda x: x.iteritems()
@@ -22,6 +24,8 @@ else:
     import itertools
     zip = itertools.izip
     map = itertools.imap
+    # atomically replaces existing files on posix, python 2 has nothing better on windows
+    replace_file = os.rename
 
     def py2_unicode_compatible(cls):
         cls.__unicode__ = cls.__str__
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+
+from common import PrassError, itervalues
+from subs import AssScript, AssEvent, SCRIPT_INFO_SECTION, STYLES_SECTION, EVENTS_SECTION
+from tools import hash_file
+
+
+SCHEMA = u"""
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    hash TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    width INTEGER,
+    height INTEGER
+);
+CREATE TABLE IF NOT EXISTS styles (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    name TEXT NOT NULL,
+    definition TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS styles_name ON styles(name);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    kind TEXT, layer INTEGER, start INTEGER, "end" INTEGER, style TEXT, actor TEXT,
+    margin_left INTEGER, margin_right INTEGER, margin_vertical INTEGER, effect TEXT, text TEXT
+);
+CREATE INDEX IF NOT EXISTS events_file ON events(file_id);
+CREATE INDEX IF NOT EXISTS events_style ON events(style);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts4(text);
+"""
+
+EVENT_COLUMNS = u'kind, layer, start, "end", style, actor, margin_left, margin_right, margin_vertical, effect, text'
+
+
+class CorpusIndex(object):
+    """SQLite index of events, styles and resolutions of many scripts.
+    Files are only parsed again when their content hash changes."""
+    def __init__(self, path):
+        super(CorpusIndex, self).__init__()
+        self._connection = sqlite3.connect(path)
+        try:
+            self._connection.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            raise PrassError(u"Couldn't create the index: {0}".format(e))
+
+    def close(self):
+        self._connection.close()
+
+    def _remove_file(self, file_id):
+        cursor = self._connection.cursor()
+        cursor.execute(u"DELETE FROM events_fts WHERE rowid IN (SELECT id FROM events WHERE file_id = ?)", (file_id,))
+        cursor.execute(u"DELETE FROM events WHERE file_id = ?", (file_id,))
+        cursor.execute(u"DELETE FROM styles WHERE file_id = ?", (file_id,))
+        cursor.execute(u"DELETE FROM files WHERE id = ?", (file_id,))
+
+    def update(self, paths):
+        """Index the scripts, returning the list of paths that actually had to be parsed"""
+        updated = []
+        cursor = self._connection.cursor()
+        for path in paths:
+            path = os.path.abspath(path)
+            digest = hash_file(path)
+            row = cursor.execute(u"SELECT id, hash FROM files WHERE path = ?", (path,)).fetchone()
+            if row and row[1] == digest:
+                continue
+
+            try:
+                script = AssScript.from_ass_file(path)
+            except PrassError as e:
+                raise PrassError(u"Couldn't index {0}: {1}".format(path, e.message))
+            # scripts without a section, like old SSA files with [V4 Styles], have nothing of it indexed
+            styles_section = script._find_section(STYLES_SECTION)
+            events_section = script._find_section(EVENTS_SECTION)
+            styles = itervalues(styles_section.styles) if styles_section else []
+            events = events_section.events if events_section else []
+            with self._connection:
+                if row:
+                    self._remove_file(row[0])
+                script_info = script._find_section(SCRIPT_INFO_SECTION)
+                width, height = script_info.get_resolution() if script_info else (None, None)
+                cursor.execute(u"INSERT INTO files (path, hash, mtime, width, height) VALUES (?, ?, ?, ?, ?)",
+                               (path, digest, os.path.getmtime(path), width, height))
+                file_id = cursor.lastrowid
+                cursor.executemany(u"INSERT INTO styles (file_id, name, definition) VALUES (?, ?, ?)",
+                                   ((file_id, x.name, x.definition) for x in styles))
+                cursor.executemany(
+                    u"INSERT INTO events (file_id, {0}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(EVENT_COLUMNS),
+                    ((file_id, e.kind, e.layer, e.start, e.end, e.style, e.actor, e.margin_left, e.margin_right,
+                      e.margin_vertical, e.effect, e.text) for e in events))
+                cursor.execute(u"INSERT INTO events_fts (rowid, text) SELECT id, text FROM events WHERE file_id = ?",
+                               (file_id,))
+            updated.append(path)
+        return updated
+
+    def search(self, query, style=None):
+        """Full-text search over event text, yielding (path, event) pairs"""
+        sql = (u"SELECT files.path, {0} FROM events_fts JOIN events ON events.id = events_fts.rowid "
+               u"JOIN files ON files.id = events.file_id WHERE events_fts MATCH ?").format(
+            u", ".join(u"events." + x.strip() for x in EVENT_COLUMNS.split(u",")))
+        args = [query]
+        if style:
+            sql += u" AND events.style = ?"
+            args.append(style)
+        sql += u" ORDER BY files.path, events.id"
+        for row in self._connection.execute(sql, args):
+            kind, layer, start, end, style, actor, margin_left, margin_right, margin_vertical, effect, text = row[1:]
+            yield row[0], AssEvent(start, end, text, kind, layer, style, actor,
+                                   margin_left, margin_right, margin_vertical, effect)
+
+    def find_style(self, name):
+        """Definitions of a style in all indexed scripts as (path, definition, width, height) tuples,
+        most recently modified script first"""
+        return self._connection.execute(
+            u"SELECT files.path, styles.definition, files.width, files.height FROM styles "
+            u"JOIN files ON files.id = styles.file_id WHERE styles.name = ? ORDER BY files.mtime DESC", (name,))
@@ -1,10 +1,22 @@
 #!/usr/bin/env python2
 import click
+import codecs
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
 import sys
+import tempfile
 from operator import attrgetter
-from common import PrassError, zip, map
-from subs import AssScript
-from tools import Timecodes, parse_keyframes
+from common import PrassError, zip, map, replace_file
+from subs import AssScript, EventsSection, ExternalSortEventsSection, WindowEventsSection, EventMatcher, EventTransform, \
+    diff_events
+from tools import Timecodes, parse_keyframes, hash_file
+from corpus import CorpusIndex
+from stats import ScriptStats, CSV_COLUMNS
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -63,13 +75,164 @@ def parse_resolution_string(resolution_string):
     raise PrassError("Invalid resolution string: '{0}'".format(resolution_string))
 
 
+def split_names(values):
+    names = []
+    for value in values:
+        names.extend(x.strip() for x in value.split(','))
+    return names
+
+
+def map_parallel(function, items, jobs):
+    if jobs > 1 and len(items) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(items)))
+        try:
+            return pool.map(function, items, chunksize=1)
+        finally:
+            pool.close()
+    return [function(x) for x in items]
+
+
+def _grep_file(args):
+    path, matcher = args
+    return path, [u"%s" % e for e in AssScript.from_ass_file(path).find_events(matcher)]
+
+
+def _replace_file(args):
+    path, matcher, replacement = args
+    script = AssScript.from_ass_file(path)
+    count = script.replace_text(matcher, replacement)
+    if count:
+        script.to_ass_file(path)
+    return path, count
+
+
+def _map_file(args):
+    path, transform = args
+    script = AssScript.from_ass_file(path)
+    script.map_events(transform)
+    script.to_ass_file(path)
+    return path
+
+
+def _stats_file(path):
+    return path, ScriptStats.from_file(path)
+
+
+def _file_name(value):
+    name = getattr(value, 'name', value)
+    return name if isinstance(name, str) and name not in ('-', '<stdin>', '<stdout>') else None
+
+
+def _command_signature(ctx):
+    """Hash of the command, its options and contents of all input files, None if some input is stdin"""
+    hasher = hashlib.sha1(ctx.command_path.encode('utf-8'))
+    for params in (ctx.find_root().params, ctx.params):
+        for name in sorted(params):
+            if name in ('output_file', 'manifest_path', 'cache_dir'):
+                continue
+            values = params[name] if isinstance(params[name], (list, tuple)) else [params[name]]
+            for value in values:
+                path = _file_name(value)
+                if path and os.path.isfile(path):
+                    description = u"{0}={1}:{2}".format(name, path, hash_file(path))
+                elif hasattr(value, 'read'):
+                    return None
+                else:
+                    description = u"{0}={1!r}".format(name, value)
+                hasher.update(description.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def skip_if_up_to_date():
+    """Exit without doing anything if neither inputs nor options changed since the output was last written"""
+    ctx = click.get_current_context()
+    manifest_path = ctx.find_root().params.get('manifest_path')
+    if not manifest_path or 'signature' in ctx.meta:
+        return
+    ctx.meta['signature'] = signature = _command_signature(ctx)
+    output_path = _file_name(ctx.params.get('output_file'))
+    if signature and output_path and os.path.isfile(output_path) and \
+            _load_manifest(manifest_path).get(os.path.abspath(output_path)) == signature:
+        ctx.exit()
+
+
+def _update_manifest(ctx, output_path):
+    manifest_path = ctx.find_root().params.get('manifest_path')
+    signature = ctx.meta.get('signature')
+    if not manifest_path or not output_path:
+        return
+    manifest = _load_manifest(manifest_path)
+    if signature:
+        manifest[os.path.abspath(output_path)] = signature
+    else:
+        manifest.pop(os.path.abspath(output_path), None)
+    # written next to the manifest and moved over it, so other runs never read it half written
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_path)))
+    with os.fdopen(handle, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    replace_file(temp_path, manifest_path)
+
+
+def get_cache_dir():
+    return click.get_current_context().find_root().params.get('cache_dir')
+
+
+def read_script(input_file, events_section_factory=EventsSection):
+    skip_if_up_to_date()
+    parse_jobs = click.get_current_context().find_root().params.get('parse_jobs') or 1
+    name = getattr(input_file, 'name', None)
+    if parse_jobs > 1 and isinstance(name, str) and os.path.isfile(name):
+        return AssScript.from_ass_file(name, events_section_factory, parse_jobs)
+    return AssScript.from_stream(input_file, events_section_factory)
+
+
+def write_script(script, output_file):
+    ctx = click.get_current_context()
+    root_params = ctx.find_root().params
+    output_path = _file_name(output_file)
+    if root_params.get('pipe_format') == 'binary' and getattr(output_file, 'name', None) == '<stdout>':
+        script.to_binary_stream(output_file)
+    elif root_params.get('if_changed') and output_path:
+        # output is a lazy file, it's not even opened if the content is the same
+        buffer = io.BytesIO()
+        script.to_ass_stream(codecs.getwriter('utf-8-sig')(buffer))
+        data = buffer.getvalue()
+        if not os.path.isfile(output_path) or hash_file(output_path) != hashlib.sha1(data).hexdigest():
+            output_file.write(data)
+    else:
+        script.to_ass_stream(codecs.getwriter('utf-8-sig')(output_file))
+    _update_manifest(ctx, output_path)
+
+
 @click.group(context_settings=CONTEXT_SETTINGS)
-def cli():
+@click.option('--pipe-format', 'pipe_format', default='ass', type=click.Choice(['ass', 'binary']),
+              help="Format of scripts written to stdout. Binary is faster to pass to another prass command, "
+                   "which detects it automatically")
+@click.option('--parse-jobs', 'parse_jobs', default=1, type=click.IntRange(1, None), metavar="<count>",
+              help="Number of processes used to parse events of input files, useful for huge scripts")
+@click.option('--if-changed', 'if_changed', default=False, is_flag=True,
+              help="Don't touch output files if their content would stay the same")
+@click.option('--manifest', 'manifest_path', default=None, type=click.Path(dir_okay=False), metavar="<path>",
+              help="Remember hashes of inputs and options in this file "
+                   "and skip commands whose inputs and options didn't change since the last run")
+@click.option('--cache-dir', 'cache_dir', default=None, metavar="<path>",
+              type=click.Path(exists=True, file_okay=False, writable=True),
+              help="Keep parsed keyframes and timecodes in binary files in this directory, "
+                   "so that concurrent prass processes share one memory-mapped copy")
+def cli(pipe_format, parse_jobs, if_changed, manifest_path, cache_dir):
     pass
 
 
 @cli.command("convert-srt", short_help="convert srt subtitles to ass")
-@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8-sig", mode='w'))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'))
 @click.option("--encoding", "encoding", default='utf-8-sig', help="Encoding to use for the input SRT file")
 @click.argument("input_path", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
 def convert_srt(input_path, output_file, encoding):
@@ -81,16 +244,47 @@ def convert_srt(input_path, output_file, encoding):
     """
     try:
         with click.open_file(input_path, encoding=encoding) as input_file:
-            AssScript.from_srt_stream(input_file).to_ass_stream(output_file)
+            write_script(AssScript.from_srt_stream(input_file), output_file)
     except LookupError:
         raise PrassError("Encoding {0} doesn't exist".format(encoding))
 
 
+@cli.command("export", short_help="export ass script to srt, webvtt or ass")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option("-o", "--output", "output_paths", multiple=True, required=True, type=click.Path(dir_okay=False, writable=True),
+              metavar="<path>", help="Output file, format is determined by the extension: .srt, .vtt or .ass. "
+                                     "Supply it multiple times to write several formats at once")
+def export(input_file, output_paths):
+    """Export ASS script to SRT or WebVTT.
+    Override tags are removed except italic, bold, underline and strikeout which are converted to html.
+    Comments are skipped. The script is only parsed once, no matter how many outputs you specify.
+
+    \b
+    Example:
+    $ prass export input.ass -o output.srt -o output.vtt
+    """
+    writers = {
+        ".srt": "to_srt_stream",
+        ".vtt": "to_vtt_stream",
+        ".ass": "to_ass_stream",
+    }
+    for path in output_paths:
+        if os.path.splitext(path)[1].lower() not in writers:
+            raise PrassError("Unknown output format of {0}".format(path))
+
+    script = read_script(input_file)
+    for path in output_paths:
+        extension = os.path.splitext(path)[1].lower()
+        encoding = 'utf-8-sig' if extension == '.ass' else 'utf-8'
+        with codecs.open(path, encoding=encoding, mode='w') as output_file:
+            getattr(script, writers[extension])(output_file)
+
+
 @cli.command('copy-styles', short_help="copy styles from one ass script to another")
-@click.option("-o", "--output", "output_file", default="-", type=click.File(encoding="utf-8-sig", mode='w'))
-@click.option('--to', 'dst_file', required=True, type=click.File(encoding='utf-8-sig', mode='r'),
+@click.option("-o", "--output", "output_file", default="-", type=click.File(mode='wb'))
+@click.option('--to', 'dst_file', required=True, type=click.File(mode='rb'),
               help="File to copy the styles to")
-@click.option('--from', 'src_file', required=True, type=click.File(encoding='utf-8-sig', mode='r'),
+@click.option('--from', 'src_file', required=True, type=click.File(mode='rb'),
               help="File to take the styles from")
 @click.option('--clean', default=False, is_flag=True,
               help="Remove all older styles in the destination file")
@@ -107,22 +301,102 @@ def copy_styles(dst_file, src_file, output_file, clean, resample, forced_resolut
     With pipes:
     $ cat unstyled.ass | prass copy-styles --from template.ass | prass cleanup --comments -o out.ass
     """
-    src_script = AssScript.from_ass_stream(src_file)
-    dst_script = AssScript.from_ass_stream(dst_file)
+    src_script = read_script(src_file)
+    dst_script = read_script(dst_file)
     if forced_resolution:
         forced_resolution = parse_resolution_string(forced_resolution)
 
     dst_script.append_styles(src_script, clean, resample, forced_resolution)
-    dst_script.to_ass_stream(output_file)
+    write_script(dst_script, output_file)
+
+
+@cli.command('merge', short_help="merge several ass scripts into one")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--on-conflict', 'on_conflict', default='keep', type=click.Choice(['keep', 'replace', 'error']),
+              help="What to do with styles that have the same name but different definitions: "
+                   "keep the first one, replace it with the last one or abort")
+@click.option('--resample/--no-resample', 'resample', default=True,
+              help="Resample styles to the resolution of the first script when possible")
+@click.option('--resolution', 'forced_resolution', default=None, help="Resample everything to this resolution")
+def merge(input_paths, output_file, on_conflict, resample, forced_resolution):
+    """Merge events and styles of several ASS scripts, sorting events by start time.
+    Script info and all other sections are taken from the first script.
+    Inputs that are already sorted by time are merged in a streaming fashion without loading their events into memory.
+
+    \b
+    Example:
+    $ prass merge dialogue.ass signs.ass karaoke.ass -o release.ass
+    """
+    if forced_resolution:
+        forced_resolution = parse_resolution_string(forced_resolution)
+
+    skip_if_up_to_date()
+    result = AssScript.merge_files(input_paths, on_conflict, resample, forced_resolution)
+    write_script(result, output_file)
+
+
+@cli.command('overlaps', short_help="report overlapping events")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8", mode='w'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option('--by', 'group_by', multiple=True, help="Only report overlaps of events with the same value of this field",
+              type=click.Choice(['style', 'actor', 'layer']))
+@click.option('--comments', 'include_comments', default=False, is_flag=True, help="Also check commented lines")
+def overlaps(input_file, output_file, group_by, include_comments):
+    """Report all pairs of overlapping events.
+
+    \b
+    To find overlapping lines of the same style on the same layer:
+    $ prass overlaps input.ass --by style --by layer
+    """
+    script = read_script(input_file)
+    index = script.build_events_index(include_comments)
+    group_key = attrgetter(*group_by) if group_by else None
+    for first, second in index.overlapping_pairs(group_key):
+        output_file.write(u"{0}\n{1}\n\n".format(first, second))
+
+
+@cli.command('resample', short_help="resample script to another resolution")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option('--resolution', 'resolution', required=True, help="Target resolution, like 1080p or 1920x1080")
+@click.option('--from-resolution', 'source_resolution', default=None,
+              help="Assume this resolution of the input script instead of PlayResX and PlayResY")
+@click.option('-j', '--jobs', 'jobs', default=1, type=click.IntRange(1, None), metavar="<count>",
+              help="Number of processes used to rewrite override tags")
+def resample(input_file, output_file, resolution, source_resolution, jobs):
+    """Resample script to another resolution.
+    Unlike copy-styles, this also rescales margins of events and override tags like \\pos, \\move, \\fs,
+    \\bord or \\clip and vector drawings.
+
+    \b
+    Example:
+    $ prass resample input.ass --resolution 1080p -o output.ass
+    """
+    width, height = parse_resolution_string(resolution)
+    if source_resolution:
+        source_resolution = parse_resolution_string(source_resolution)
+    script = read_script(input_file)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            script.resample(width, height, source_resolution, pool)
+        finally:
+            pool.close()
+    else:
+        script.resample(width, height, source_resolution)
+    write_script(script, output_file)
 
 
 @cli.command('sort', short_help="sort ass script events")
-@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8-sig", mode='w'), metavar="<path>")
-@click.argument("input_file", type=click.File(encoding="utf-8-sig"))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
 @click.option('--by', 'sort_by', multiple=True, default=['start'], help="Parameter to sort by",
               type=click.Choice(['time', 'start', 'end', 'style', 'actor', 'effect', 'layer']))
 @click.option('--desc', 'descending', default=False, is_flag=True, help="Descending order")
-def sort_script(input_file, output_file, sort_by, descending):
+@click.option('--buffer-size', 'buffer_size', default=None, type=click.IntRange(1, None), metavar="<events>",
+              help="Keep at most this many events in memory, spilling sorted runs to temporary files")
+def sort_script(input_file, output_file, sort_by, descending, buffer_size):
     """Sort script by one or more parameters.
 
     \b
@@ -130,9 +404,10 @@ def sort_script(input_file, output_file, sort_by, descending):
     $ prass sort input.ass --by time -o output.ass
     Sorting by time and then by layer, both in descending order:
     $ prass sort input.ass --by time --by layer --desc -o output.ass
+    Sorting a huge script without loading all events into memory:
+    $ prass sort input.ass --by time --buffer-size 100000 -o output.ass
 
     """
-    script = AssScript.from_ass_stream(input_file)
     attrs_map = {
         "start": "start",
         "time": "start",
@@ -143,13 +418,18 @@ def sort_script(input_file, output_file, sort_by, descending):
         "layer": "layer"
     }
     getter = attrgetter(*[attrs_map[x] for x in sort_by])
-    script.sort_events(getter, descending)
-    script.to_ass_stream(output_file)
+    if buffer_size:
+        script = read_script(
+            input_file, events_section_factory=lambda: ExternalSortEventsSection(getter, descending, buffer_size))
+    else:
+        script = read_script(input_file)
+        script.sort_events(getter, descending)
+    write_script(script, output_file)
 
 
 @cli.command('tpp', short_help="timing post-processor")
-@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8-sig", mode='w'), metavar="<path>")
-@click.argument("input_file", type=click.File(encoding="utf-8-sig"))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
 @click.option("-s", "--style", "styles", multiple=True, metavar="<names>",
               help="Style names to process. All by default. Use comma to separate, or supply it multiple times")
 @click.option("--lead-in", "lead_in", default=0, type=int, metavar="<ms>",
@@ -178,8 +458,11 @@ def sort_script(input_file, output_file, sort_by, descending):
               help="Max distance between a keyframe and event end for it to be snapped, when keyframe is placed before the end time")
 @click.option("--kf-after-end", default=0, type=float, metavar="<ms>",
               help="Max distance between a keyframe and event end for it to be snapped, when keyframe is placed after the event")
+@click.option("--max-cps", "max_cps", default=0, type=float, metavar="<float>",
+              help="Extend end times of lines faster than this many characters per second, "
+                   "up to the next line of the same style and the next keyframe")
 def tpp(input_file, output_file, styles, lead_in, lead_out, max_overlap, max_gap, adjacent_bias,
-        keyframes_path, timecodes_path, fps, kf_before_start, kf_after_start, kf_before_end, kf_after_end):
+        keyframes_path, timecodes_path, fps, kf_before_start, kf_after_start, kf_before_end, kf_after_end, max_cps):
     """Timing post-processor.
     It's a pretty straightforward port from Aegisub so you should be familiar with it.
     You have to specify keyframes and timecodes (either as a CFR value or a timecodes file) if you want keyframe snapping.
@@ -192,15 +475,17 @@ def tpp(input_file, output_file, styles, lead_in, lead_out, max_overlap, max_gap
     $ prass tpp input.ass --overlap 50 --gap 200 --bias 80 -o output.ass
     To snap events to keyframes without a timecodes file:
     $ prass tpp input.ass --keyframes kfs.txt --fps 23.976 --kf-before-end 150 --kf-after-end 150 --kf-before-start 150 --kf-after-start 150 -o output.ass
+    To make lines readable at 20 characters per second without crossing keyframes:
+    $ prass tpp input.ass --max-cps 20 --keyframes kfs.txt --fps 23.976 -o output.ass
     """
-
+    skip_if_up_to_date()
     if fps and timecodes_path:
         raise PrassError('Timecodes file and fps cannot be specified at the same time')
     if fps:
         timecodes = Timecodes.cfr(parse_fps_string(fps))
     elif timecodes_path:
-        timecodes = Timecodes.from_file(timecodes_path)
-    elif any((kf_before_start, kf_after_start, kf_before_end, kf_after_end)):
+        timecodes = Timecodes.from_file(timecodes_path, get_cache_dir())
+    elif any((kf_before_start, kf_after_start, kf_before_end, kf_after_end)) or (max_cps and keyframes_path):
         raise PrassError('You have to provide either fps or timecodes file for keyframes processing')
     else:
         timecodes = None
@@ -208,21 +493,17 @@ def tpp(input_file, output_file, styles, lead_in, lead_out, max_overlap, max_gap
     if timecodes and not keyframes_path:
         raise PrassError('You have to specify keyframes file for keyframes processing')
 
-    keyframes_list = parse_keyframes(keyframes_path) if keyframes_path else None
-
-    actual_styles = []
-    for style in styles:
-        actual_styles.extend(x.strip() for x in style.split(','))
+    keyframes_list = parse_keyframes(keyframes_path, get_cache_dir()) if keyframes_path else None
 
-    script = AssScript.from_ass_stream(input_file)
-    script.tpp(actual_styles, lead_in, lead_out, max_overlap, max_gap, adjacent_bias,
-               keyframes_list, timecodes, kf_before_start, kf_after_start, kf_before_end, kf_after_end)
-    script.to_ass_stream(output_file)
+    script = read_script(input_file)
+    script.tpp(split_names(styles), lead_in, lead_out, max_overlap, max_gap, adjacent_bias,
+               keyframes_list, timecodes, kf_before_start, kf_after_start, kf_before_end, kf_after_end, max_cps)
+    write_script(script, output_file)
 
 
 @cli.command("cleanup", short_help="remove useless data from ass scripts")
-@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8-sig", mode='w'), metavar="<path>")
-@click.argument("input_file", type=click.File(encoding="utf-8-sig"))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
 @click.option("--comments", "drop_comments", default=False, is_flag=True,
               help="Remove commented lines")
 @click.option("--empty-lines", "drop_empty_lines", default=False, is_flag=True,
@@ -253,21 +534,490 @@ def cleanup(input_file, output_file, drop_comments, drop_empty_lines, drop_unuse
     }
     drop_sections = [sections_map[x] for x in drop_sections]
 
-    script = AssScript.from_ass_stream(input_file)
+    script = read_script(input_file)
     script.cleanup(drop_comments, drop_empty_lines, drop_unused_styles, drop_actors, drop_effects, drop_spacing, drop_sections)
-    script.to_ass_stream(output_file)
+    write_script(script, output_file)
+
+
+@cli.command("dedupe", short_help="remove duplicate events")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option("--exact-only", "exact_only", default=False, is_flag=True,
+              help="Only remove exact duplicates, don't merge touching lines with the same text")
+@click.option("--quiet", "quiet", default=False, is_flag=True, help="Don't report removed lines")
+def dedupe(input_file, output_file, exact_only, quiet):
+    """Remove duplicate events.
+    Events with the same text, style and layer that overlap or touch each other are merged into a single event.
+    Every removed line is reported to stderr.
+
+    \b
+    Example:
+    $ prass dedupe input.ass -o output.ass
+    """
+    script = read_script(input_file)
+    removed = script.dedupe(merge_adjacent=not exact_only)
+    if not quiet:
+        for kept, event in removed:
+            click.echo(u"Removed: {0}\nKept:    {1}".format(event, kept), err=True)
+        click.echo(u"Removed {0} events".format(len(removed)), err=True)
+    write_script(script, output_file)
+
+
+@cli.command("diff", short_help="show changed events between two scripts")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8", mode='w'), metavar="<path>")
+@click.argument("old_file", type=click.File(mode='rb'))
+@click.argument("new_file", type=click.File(mode='rb'))
+@click.option("--format", "output_format", default="text", type=click.Choice(["text", "json"]), help="Output format")
+@click.option("--tolerance", "time_tolerance", default=1000, type=click.IntRange(0, None), metavar="<ms>",
+              help="Max start time difference for lines with different text to be considered the same line")
+def diff(old_file, new_file, output_file, output_format, time_tolerance):
+    """Compare events of two scripts, ignoring their order.
+    Lines are matched by text first, so sorting or retiming a script doesn't make everything look changed.
+
+    \b
+    Example:
+    $ prass diff old.ass new.ass --format json -o changes.json
+    """
+    old_script = read_script(old_file)
+    new_script = read_script(new_file)
+    changes = diff_events(old_script._events, new_script._events, time_tolerance)
+
+    if output_format == "json":
+        to_string = lambda x: None if x is None else u"%s" % x
+        json.dump([{"change": change, "old": to_string(old), "new": to_string(new)} for change, old, new in changes],
+                  output_file, indent=2, ensure_ascii=False)
+        output_file.write(u"\n")
+        return
+
+    for change, old, new in changes:
+        output_file.write(u"{0}\n".format(change))
+        if old is not None:
+            output_file.write(u"- {0}\n".format(old))
+        if new is not None:
+            output_file.write(u"+ {0}\n".format(new))
+        output_file.write(u"\n")
+
+
+def event_filter_options(function):
+    function = click.option("-s", "--style", "styles", multiple=True, metavar="<names>",
+                            help="Only look at events with these styles. Use comma to separate, or supply it multiple times")(function)
+    function = click.option("--actor", "actors", multiple=True, metavar="<names>",
+                            help="Only look at events with these actors")(function)
+    function = click.option("--layer", "layers", multiple=True, type=int, metavar="<layer>",
+                            help="Only look at events on these layers")(function)
+    function = click.option("--ignore-tags", "ignore_tags", default=False, is_flag=True,
+                            help="Don't match text inside override blocks")(function)
+    function = click.option("-i", "--ignore-case", "ignore_case", default=False, is_flag=True,
+                            help="Case-insensitive matching")(function)
+    function = click.option("-j", "--jobs", "jobs", default=1, type=click.IntRange(1, None), metavar="<count>",
+                            help="Number of files processed in parallel")(function)
+    return function
+
+
+def build_matcher(pattern, styles, actors, layers, ignore_tags, ignore_case):
+    try:
+        return EventMatcher(pattern, split_names(styles), split_names(actors), layers, ignore_tags, ignore_case)
+    except re.error as e:
+        raise PrassError(u"Invalid regular expression: {0}".format(e))
+
+
+@cli.command("grep", short_help="search event text in many scripts")
+@click.argument("pattern")
+@click.argument("input_paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@event_filter_options
+def grep(pattern, input_paths, styles, actors, layers, ignore_tags, ignore_case, jobs):
+    """Print events with text matching a regular expression.
+
+    \b
+    Example:
+    $ prass grep -s default,alt --ignore-tags "Shin-?chan" ep*.ass
+    """
+    matcher = build_matcher(pattern, styles, actors, layers, ignore_tags, ignore_case)
+    for path, lines in map_parallel(_grep_file, [(path, matcher) for path in input_paths], jobs):
+        for line in lines:
+            click.echo(u"{0}: {1}".format(path, line))
+
+
+@cli.command("replace", short_help="replace event text in many scripts")
+@click.argument("pattern")
+@click.argument("replacement")
+@click.argument("input_paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@event_filter_options
+def replace(pattern, replacement, input_paths, styles, actors, layers, ignore_tags, ignore_case, jobs):
+    """Replace text matching a regular expression in place. Only files with at least one replacement are written.
+    Replacement can reference groups of the pattern, like \\1.
+
+    \b
+    Example:
+    $ prass replace --ignore-tags "Shinchan" "Shin-chan" ep*.ass
+    """
+    matcher = build_matcher(pattern, styles, actors, layers, ignore_tags, ignore_case)
+    try:
+        matcher.check_replacement(replacement)
+    except (re.error, IndexError) as e:
+        raise PrassError(u"Invalid replacement: {0}".format(e))
+    jobs_args = [(path, matcher, replacement) for path in input_paths]
+    for path, count in map_parallel(_replace_file, jobs_args, jobs):
+        if count:
+            click.echo(u"{0}: {1} replacements".format(path, count), err=True)
+
+
+@cli.command("map", short_help="apply python code to every event")
+@click.argument("input_paths", nargs=-1, type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.option("-e", "--expression", "expressions", multiple=True, metavar="<code>",
+              help="Python statements run for every event, supply it multiple times for several lines")
+@click.option("-f", "--file", "transform_path", type=click.Path(exists=True, readable=True, dir_okay=False),
+              metavar="<path>", help="Python file defining a transform(event) function")
+@click.option("--in-place", "in_place", default=False, is_flag=True, help="Overwrite input files")
+@click.option("-j", "--jobs", "jobs", default=1, type=click.IntRange(1, None), metavar="<count>",
+              help="Number of files processed in parallel with --in-place")
+def map_command(input_paths, output_file, expressions, transform_path, in_place, jobs):
+    """Run python code for every event. Statements given with -e can read and assign kind, layer, start, end,
+    style, actor, margin_left, margin_right, margin_vertical, effect and text, with re and strip_tags available.
+    The code is compiled only once per run.
+
+    \b
+    Example:
+    $ prass map -e "if style == 'Signs' and layer == 0: layer = 5" input.ass -o output.ass
+    $ prass map -e "end = max(end, start + 1000)" --in-place --jobs 4 ep*.ass
+    $ prass map --file fixes.py --in-place ep*.ass
+    """
+    if bool(expressions) == bool(transform_path):
+        raise PrassError('You have to provide either expressions or a transform file')
+    if transform_path:
+        with codecs.open(transform_path, encoding='utf-8-sig') as transform_file:
+            transform = EventTransform(transform_file.read(), transform_path)
+    else:
+        transform = EventTransform(u"\n".join(expressions))
+
+    if in_place:
+        if not input_paths or '-' in input_paths:
+            raise PrassError('You have to provide input files to change them in place')
+        map_parallel(_map_file, [(path, transform) for path in input_paths], jobs)
+        return
+
+    if len(input_paths) > 1:
+        raise PrassError('Several input files can only be changed --in-place')
+    with click.open_file(input_paths[0] if input_paths else '-', mode='rb') as input_file:
+        script = read_script(input_file)
+    script.map_events(transform)
+    write_script(script, output_file)
+
+
+@cli.command("check", short_help="find common problems in ass scripts")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8", mode='w'), metavar="<path>")
+@click.option("--rule", "rules", multiple=True, metavar="<rule>",
+              type=click.Choice(['negative-duration', 'missing-style', 'overlap', 'cps', 'video-end']),
+              help="Rules to check, supply it multiple times. "
+                   "Everything that doesn't need additional parameters is checked by default")
+@click.option("--max-cps", "max_cps", type=float, metavar="<float>", help="Max characters per second, enables the cps rule")
+@click.option("--timecodes", "timecodes_path", type=click.Path(exists=True, readable=True, dir_okay=False), metavar="<path>",
+              help="Timecodes file of the video, enables the video-end rule")
+@click.option("--video-frames", "video_frames", type=click.IntRange(1, None), metavar="<count>",
+              help="Number of frames in the video, required with v1 timecodes that don't say where the video ends")
+@click.option("--format", "output_format", default="text", type=click.Choice(["text", "json"]), help="Output format")
+@click.pass_context
+def check(ctx, input_file, output_file, rules, max_cps, timecodes_path, video_frames, output_format):
+    """Check the script for negative durations, unknown styles, overlapping lines of the same style,
+    lines that are too fast to read and lines ending after the end of the video.
+    Exits with code 3 if any problem was found, errors like an unreadable script or wrong options exit with 1 or 2.
+
+    \b
+    Example:
+    $ prass check input.ass --max-cps 25 --timecodes tc.txt --format json
+    """
+    rules = set(rules or ['negative-duration', 'missing-style', 'overlap'])
+    if max_cps and not ctx.params.get('rules'):
+        rules.add('cps')
+    if timecodes_path and not ctx.params.get('rules'):
+        rules.add('video-end')
+    if 'cps' in rules and not max_cps:
+        raise PrassError('You have to specify --max-cps for the cps rule')
+    if 'video-end' in rules and not timecodes_path:
+        raise PrassError('You have to specify --timecodes for the video-end rule')
+
+    video_end = None
+    if timecodes_path:
+        timecodes = Timecodes.from_file(timecodes_path, get_cache_dir())
+        # v1 timecodes only list frames up to the last override, the video can go on after it
+        if timecodes.default_fps and not video_frames:
+            raise PrassError('v1 timecodes files don\'t say how long the video is, specify --video-frames')
+        if not timecodes.times and not video_frames:
+            raise PrassError('Timecodes file has no frames')
+        try:
+            # the video ends when its last frame does
+            video_end = timecodes.get_frame_time(video_frames or len(timecodes.times))
+        except ValueError:
+            raise PrassError('Timecodes file needs at least two frames to know when the video ends')
+
+    script = read_script(input_file)
+    issues = script.check(rules, max_cps, video_end)
+
+    if output_format == "json":
+        json.dump([{"line": idx, "rule": rule, "event": u"%s" % event} for idx, rule, event in issues],
+                  output_file, indent=2, ensure_ascii=False)
+        output_file.write(u"\n")
+    else:
+        for idx, rule, event in issues:
+            output_file.write(u"{0}: {1}: {2}\n".format(idx, rule, event))
+    if issues:
+        ctx.exit(3)
+
+
+@cli.command("stats", short_help="summarize scripts")
+@click.argument("input_paths", nargs=-1, type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8", mode='w'), metavar="<path>")
+@click.option("--format", "output_format", default="json", type=click.Choice(["json", "csv"]),
+              help="Output format. CSV only has the number of distinct styles, actors and attachments")
+@click.option("-j", "--jobs", "jobs", default=1, type=click.IntRange(1, None), metavar="<count>",
+              help="Number of files processed in parallel")
+def stats(input_paths, output_file, output_format, jobs):
+    """Count events by style and actor, durations, reading speed distribution, override tags,
+    attachment sizes and resolutions of scripts, one by one and in total.
+    Scripts are read in a single pass without loading events.
+
+    \b
+    Example:
+    $ prass stats ep*.ass --jobs 4 --format csv -o season.csv
+    """
+    input_paths = input_paths or ('-',)
+    files = [x for x in input_paths if x != '-']
+    results = map_parallel(_stats_file, files, jobs)
+    if '-' in input_paths:
+        with click.open_file('-', mode='rb') as stdin:
+            results.insert(input_paths.index('-'), ('-', ScriptStats.from_byte_stream(stdin)))
+
+    total = ScriptStats()
+    for _, file_stats in results:
+        total.merge(file_stats)
+
+    if output_format == "json":
+        summary = {"files": [dict(file_stats.to_dict(), path=path) for path, file_stats in results],
+                   "total": total.to_dict()}
+        json.dump(summary, output_file, indent=2, ensure_ascii=False)
+        output_file.write(u"\n")
+    else:
+        writer = csv.writer(output_file, lineterminator="\n")
+        writer.writerow(CSV_COLUMNS)
+        writer.writerows(file_stats.to_csv_row(path) for path, file_stats in results)
+        writer.writerow(total.to_csv_row("total"))
+
+
+@cli.command("fonts", short_help="extract embedded fonts")
+@click.argument("input_paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("-d", "--directory", "directory", required=True, metavar="<path>",
+              type=click.Path(file_okay=False, writable=True), help="Directory to extract fonts to")
+@click.option("--strip", "strip", default=False, is_flag=True,
+              help="Remove the fonts section from input scripts after extracting")
+def fonts(input_paths, directory, strip):
+    """Extract fonts embedded in the [Fonts] section of scripts.
+    Every distinct font is written only once, even if it's embedded in many scripts.
+    Different fonts with the same file name get their hash appended to the name.
+
+    \b
+    Example:
+    $ prass fonts ep*.ass -d fonts --strip
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    written = {}
+    for path in input_paths:
+        script = AssScript.from_ass_file(path)
+        for name, data in script.iter_attachments(u"[Fonts]"):
+            digest = hashlib.sha1(data).hexdigest()
+            if digest in written:
+                continue
+            target = os.path.join(directory, os.path.basename(name))
+            if os.path.exists(target) and hash_file(target) != digest:
+                stem, extension = os.path.splitext(target)
+                target = u"{0}.{1}{2}".format(stem, digest[:8], extension)
+            if not os.path.exists(target):
+                with open(target, 'wb') as font_file:
+                    font_file.write(data)
+                click.echo(u"{0}: extracted {1}".format(path, target), err=True)
+            written[digest] = target
+
+        if strip and script.remove_sections([u"[Fonts]"]):
+            script.to_ass_file(path)
+
+
+@cli.group("index", short_help="search a local index of many scripts")
+def index():
+    """Keep a SQLite index of events and styles of many scripts to search them without parsing every file."""
+    pass
+
+
+@index.command("update", short_help="add or refresh scripts in the index")
+@click.argument("database_path", type=click.Path(dir_okay=False))
+@click.argument("input_paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def index_update(database_path, input_paths):
+    """Add scripts to the index. Scripts that didn't change since the last update are skipped.
+
+    \b
+    Example:
+    $ prass index update archive.db archive/*/*.ass
+    """
+    corpus = CorpusIndex(database_path)
+    try:
+        updated = corpus.update(input_paths)
+    finally:
+        corpus.close()
+    click.echo(u"Indexed {0} scripts, {1} were up to date".format(len(updated), len(input_paths) - len(updated)), err=True)
+
+
+@index.command("search", short_help="full-text search of event text")
+@click.argument("database_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("query")
+@click.option("-s", "--style", "style", default=None, help="Only look at events with this style")
+def index_search(database_path, query, style):
+    """Find events containing words in the query, using SQLite full-text query syntax.
+
+    \b
+    Example:
+    $ prass index search archive.db "Shin NEAR chan"
+    """
+    corpus = CorpusIndex(database_path)
+    try:
+        for path, event in corpus.search(query, style):
+            click.echo(u"{0}: {1}".format(path, event))
+    finally:
+        corpus.close()
+
+
+@index.command("style", short_help="find scripts using a style")
+@click.argument("database_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("name")
+@click.option("--latest", "latest", default=False, is_flag=True,
+              help="Only print the definition from the most recently modified script")
+def index_style(database_path, name, latest):
+    """Print definitions of a style in all indexed scripts, most recently modified first.
+
+    \b
+    Example:
+    $ prass index style archive.db Default --latest
+    """
+    corpus = CorpusIndex(database_path)
+    try:
+        for path, definition, width, height in corpus.find_style(name):
+            click.echo(u"{0} ({1}x{2}): Style: {3},{4}".format(path, width, height, name, definition))
+            if latest:
+                break
+    finally:
+        corpus.close()
+
+
+@cli.command("slice", short_help="extract events in a time window")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option("--from", "start", default="0", metavar="<time>", help="Start of the window, same format as in shift")
+@click.option("--to", "end", required=True, metavar="<time>", help="End of the window, same format as in shift")
+@click.option("--rebase", "rebase", default=False, is_flag=True, help="Shift events so that the window starts at zero")
+@click.option("--sorted", "assume_sorted", default=False, is_flag=True,
+              help="Input is sorted by start time. For a script file the end of the window is found by binary search "
+                   "and events after it are never read, from stdin they are read but dropped")
+def slice_script(input_file, output_file, start, end, rebase, assume_sorted):
+    """Extract events intersecting with a time window, keeping only styles they use.
+
+    \b
+    To extract an opening song into a separate script with times starting at zero:
+    $ prass slice input.ass --from 1:30 --to 3:00 --rebase -o op.ass
+    """
+    start, end = parse_shift_string(start), parse_shift_string(end)
+    if end <= start:
+        raise PrassError("End of the window should be after its start")
+    input_path = _file_name(input_file)
+    if assume_sorted and input_path and os.path.isfile(input_path):
+        skip_if_up_to_date()
+        script = AssScript.from_sorted_ass_file_window(input_path, start, end)
+    else:
+        script = read_script(input_file, lambda: WindowEventsSection(start, end, assume_sorted))
+    script.cleanup(False, False, True, False, False, False, [])
+    if rebase:
+        script.shift(-start, True, True, 1)
+    write_script(script, output_file)
+
+
+@cli.command("split", short_help="split script into several parts by time")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option("--at", "split_times", required=True, metavar="<times>",
+              help="Comma-separated times to split the script at, same format as in shift")
+@click.option("-o", "--output", "output_template", default=None, metavar="<template>",
+              help="Output path template where {0} is replaced with part number, "
+                   "<input name>.part{0}.ass by default")
+@click.option("--rebase", "rebase", default=False, is_flag=True, help="Shift events of every part to start at zero")
+def split(input_file, split_times, output_template, rebase):
+    """Split script into parts by event start time, keeping only styles used in each part.
+
+    \b
+    To split a two-part episode:
+    $ prass split input.ass --at 12:30 --rebase -o episode.part{0}.ass
+    """
+    times = sorted(parse_shift_string(x.strip()) for x in split_times.split(','))
+    if output_template is None:
+        name = _file_name(input_file)
+        if not name:
+            raise PrassError("You have to specify output template when reading from stdin")
+        output_template = os.path.splitext(name)[0] + u".part{0}.ass"
+    if u"{0}" not in output_template:
+        raise PrassError("Output template should contain {0}")
+
+    parts = read_script(input_file).split(times)
+    for number, (part, part_start) in enumerate(zip(parts, [0] + times), 1):
+        part.cleanup(False, False, True, False, False, False, [])
+        if rebase and part_start:
+            part.shift(-part_start, True, True, 1)
+        part.to_ass_file(output_template.format(number))
+
+
+def load_timecodes(timecodes_path, fps, name):
+    if fps and timecodes_path:
+        raise PrassError('{0} timecodes file and fps cannot be specified at the same time'.format(name))
+    if fps:
+        return Timecodes.cfr(parse_fps_string(fps))
+    if timecodes_path:
+        return Timecodes.from_file(timecodes_path, get_cache_dir())
+    raise PrassError('You have to provide either {0} fps or timecodes file'.format(name.lower()))
+
+
+@cli.command("retime", short_help="move events to another video timeline")
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
+@click.option("--from-timecodes", "source_timecodes_path", metavar="<path>",
+              type=click.Path(exists=True, readable=True, dir_okay=False), help="Timecodes file of the current video")
+@click.option("--from-fps", "source_fps", metavar="<float>", help="Fps of the current video")
+@click.option("--to-timecodes", "target_timecodes_path", metavar="<path>",
+              type=click.Path(exists=True, readable=True, dir_okay=False), help="Timecodes file of the new video")
+@click.option("--to-fps", "target_fps", metavar="<float>", help="Fps of the new video")
+def retime(input_file, output_file, source_timecodes_path, source_fps, target_timecodes_path, target_fps):
+    """Move all events from one video timeline to another, so that every event stays on the same frames.
+    Useful when the video is re-encoded with different timecodes, VFR to CFR or the other way around.
+
+    \b
+    Example:
+    $ prass retime input.ass --from-timecodes vfr.txt --to-fps 24000/1001 -o output.ass
+    """
+    skip_if_up_to_date()
+    source = load_timecodes(source_timecodes_path, source_fps, "Source")
+    target = load_timecodes(target_timecodes_path, target_fps, "Target")
+    script = read_script(input_file)
+    script.retime(source, target)
+    write_script(script, output_file)
 
 
 @cli.command("shift", short_help="shift start or end times of every event")
-@click.option("-o", "--output", "output_file", default='-', type=click.File(encoding="utf-8-sig", mode='w'), metavar="<path>")
-@click.argument("input_file", type=click.File(encoding="utf-8-sig"))
+@click.option("-o", "--output", "output_file", default='-', type=click.File(mode='wb'), metavar="<path>")
+@click.argument("input_file", type=click.File(mode='rb'))
 @click.option("--by", "shift_by", required=False, default="0", metavar="<time>",
               help="Time to shift. Might be negative. 10.5s, 150ms or 1:12.23 formats are allowed, seconds assumed by default")
 @click.option("--start", "shift_start", default=False, is_flag=True, help="Shift only start time")
 @click.option("--end", "shift_end", default=False, is_flag=True, help="Shift only end time")
 @click.option("--multiplier", "multiplier", default="1", 
               help="Multiplies timings by the value to change speed. Value is a decimal or proper fraction")
-def shift(input_file, output_file, shift_by, shift_start, shift_end, multiplier):
+@click.option("--scale-tags", "scale_tags", default=False, is_flag=True,
+              help="Also multiply times in karaoke, \\t, \\move and \\fad tags by the speed multiplier")
+def shift(input_file, output_file, shift_by, shift_start, shift_end, multiplier, scale_tags):
     """Shift all lines in a script by defined amount and/or change speed.
 
     \b
@@ -287,6 +1037,8 @@ def shift(input_file, output_file, shift_by, shift_start, shift_end, multiplier)
     $ prass shift input.ass --by 1:15 -o output.ass
     To shift only start time by half a second back:
     $ prass shift input.ass --start --by -0.5s -o output.ass
+    To change speed from 25 to 23.976 fps, keeping karaoke and animations in sync:
+    $ prass shift input.ass --multiplier 25/23.976 --scale-tags -o output.ass
     """
     if not shift_start and not shift_end:
         shift_start = shift_end = True
@@ -295,9 +1047,9 @@ def shift(input_file, output_file, shift_by, shift_start, shift_end, multiplier)
     multiplier = parse_fps_string(multiplier)
     if multiplier<0:
         raise PrassError('Speed multiplier should be a positive number')
-    script = AssScript.from_ass_stream(input_file)
-    script.shift(shift_ms, shift_start, shift_end, multiplier)
-    script.to_ass_stream(output_file)
+    script = read_script(input_file)
+    script.shift(shift_ms, shift_start, shift_end, multiplier, scale_tags)
+    write_script(script, output_file)
 
 
 if __name__ == '__main__':
@@ -305,7 +1057,11 @@ if __name__ == '__main__':
     if not sys.stdin.isatty():
         for command, arg_name in (("convert-srt", "input_path"), ("copy-styles", "dst_file"),
                                   ("sort", "input_file"), ("tpp", "input_file"), ("cleanup", "input_file"),
-                                  ('shift', "input_file")):
+                                  ('shift', "input_file"), ("overlaps", "input_file"),
+                                  ("dedupe", "input_file"), ("resample", "input_file"),
+                                  ("export", "input_file"), ("check", "input_file"),
+                                  ("slice", "input_file"), ("split", "input_file"),
+                                  ("retime", "input_file")):
             default_map[command] = {arg_name: '-'}
 
     cli(default_map=default_map)
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import sys
 import unittest
 from tests.test_subs import *
 from tests.test_tools import *
 from tests.test_main import *
+from tests.test_corpus import *
+from tests.test_stats import *
+if sys.version_info >= (3, 5):
+    from tests.test_aio import *
 
 unittest.main(verbosity=0)
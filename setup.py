@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name='Prass',
     version='0.1',
-    py_modules=['prass', 'common', 'subs', 'tools'],
+    py_modules=['prass', 'common', 'subs', 'tools', 'corpus', 'stats', 'aio'],
     install_requires=['Click'],
     entry_points='''
         [console_scripts]
@@ -0,0 +1,149 @@
+import codecs
+from collections import Counter, OrderedDict
+
+from common import PrassError, iteritems
+from subs import AssParser, AssScript, AttachmentSection, ScriptInfoSection, parse_ass_time, count_characters, \
+    decode_ass_lines, OVERRIDE_BLOCK, BINARY_MAGIC
+
+CPS_BUCKET_SIZE = 5
+
+CSV_COLUMNS = ('path', 'files', 'events', 'comments', 'styles', 'actors', 'total_duration', 'mean_duration',
+               'mean_cps', 'max_cps', 'override_tags', 'attachments', 'attachments_size', 'resolutions')
+
+
+class ScriptStats(object):
+    """Summary of one or many scripts. Instances from different files can be merged."""
+    def __init__(self):
+        super(ScriptStats, self).__init__()
+        self.files = 0
+        self.events = 0
+        self.comments = 0
+        self.styles = Counter()
+        self.actors = Counter()
+        self.total_duration = 0
+        self.cps_buckets = Counter()
+        self.cps_events = 0
+        self.total_cps = 0
+        self.max_cps = 0
+        self.override_tags = 0
+        self.attachments = Counter()
+        self.resolutions = Counter()
+
+    def add_event_line(self, text):
+        """Count an event line, splitting only the fields used in the summary"""
+        kind, _, fields = text.partition(u':')
+        if kind == u'Comment':
+            self.comments += 1
+            return
+        _, start, end, style, actor, _, _, _, _, text = fields.split(u',', 9)
+        duration = max(0, parse_ass_time(end) - parse_ass_time(start))
+        self.events += 1
+        self.styles[style] += 1
+        self.actors[actor] += 1
+        self.total_duration += duration
+        self.override_tags += sum(block.count(u'\\') for block in OVERRIDE_BLOCK.findall(text))
+        if duration:
+            cps = count_characters(text) * 1000.0 / duration
+            self.cps_buckets[int(cps // CPS_BUCKET_SIZE) * CPS_BUCKET_SIZE] += 1
+            self.cps_events += 1
+            self.total_cps += cps
+            self.max_cps = max(self.max_cps, cps)
+
+    def merge(self, other):
+        for name in ('files', 'events', 'comments', 'total_duration', 'cps_events', 'total_cps', 'override_tags'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in ('styles', 'actors', 'cps_buckets', 'attachments', 'resolutions'):
+            getattr(self, name).update(getattr(other, name))
+        self.max_cps = max(self.max_cps, other.max_cps)
+
+    def to_dict(self):
+        return {
+            'files': self.files,
+            'events': self.events,
+            'comments': self.comments,
+            'styles': dict(self.styles),
+            'actors': dict(self.actors),
+            'total_duration': self.total_duration,
+            'mean_duration': self.total_duration / float(self.events) if self.events else 0,
+            'mean_cps': self.total_cps / self.cps_events if self.cps_events else 0,
+            'max_cps': self.max_cps,
+            'cps': OrderedDict((u"{0}-{1}".format(start, start + CPS_BUCKET_SIZE), count)
+                        for start, count in sorted(iteritems(self.cps_buckets))),
+            'override_tags': self.override_tags,
+            'attachments': dict(self.attachments),
+            'resolutions': dict(self.resolutions),
+        }
+
+    def to_csv_row(self, path):
+        """Flat values for CSV_COLUMNS, distributions are reduced to the number of distinct values"""
+        summary = self.to_dict()
+        summary.update(path=path, styles=len(self.styles), actors=len(self.actors),
+                       attachments=len(self.attachments), attachments_size=sum(self.attachments.values()),
+                       resolutions=u" ".join(sorted(self.resolutions)))
+        return [summary[x] for x in CSV_COLUMNS]
+
+    @classmethod
+    def from_stream(cls, file_object):
+        """Collect stats in a single pass over lines of an ASS script, without keeping events or attachments"""
+        stats = cls()
+        parser = AssParser(lambda: _StatsEventsSection(stats), lambda: _StatsAttachmentSection(stats))
+        for line in file_object:
+            parser.parse_line(line)
+        stats.files = 1
+        script_info = next((x for _, x in parser.sections if isinstance(x, ScriptInfoSection)), None)
+        width, height = script_info.get_resolution() if script_info else (None, None)
+        if width and height:
+            stats.resolutions[u"{0}x{1}".format(width, height)] += 1
+        return stats
+
+    @classmethod
+    def from_byte_stream(cls, file_object):
+        """Collect stats from a binary stream with a script either in plain ASS or in the binary pipe format.
+        The binary format can't be read line by line, so such scripts are loaded completely."""
+        head = file_object.read(len(BINARY_MAGIC))
+        if head == BINARY_MAGIC:
+            return cls.from_stream(AssScript.from_binary_stream(file_object).iter_ass_lines())
+        return cls.from_stream(decode_ass_lines(head, file_object))
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            with codecs.open(path, encoding='utf-8-sig') as script:
+                return cls.from_stream(script)
+        except IOError:
+            raise PrassError("Script {0} not found".format(path))
+
+
+class _StatsEventsSection(object):
+    def __init__(self, stats):
+        self._stats = stats
+
+    def parse_line(self, text):
+        if not text.startswith(u'Format:'):
+            self._stats.add_event_line(text)
+
+
+class _StatsAttachmentSection(AttachmentSection):
+    def __init__(self, stats):
+        super(_StatsAttachmentSection, self).__init__()
+        self._stats = stats
+        self._name = None
+        self._encoded_length = 0
+        self._previous_size = 0
+
+    def parse_line(self, line):
+        if not line:
+            return False
+        if line.startswith(u"fontname: ") or line.startswith(u"filename: "):
+            self._name = line.partition(u": ")[2]
+            self._encoded_length = 0
+            # sizes of attachments with the same name are added up
+            self._previous_size = self._stats.attachments[self._name]
+        elif self._name is not None:
+            self._encoded_length += len(line)
+        if self._name is not None:
+            # every 4 encoded characters hold 3 bytes, a trailing group of n characters holds n - 1
+            length = self._encoded_length
+            size = length // 4 * 3 + max(0, length % 4 - 1)
+            self._stats.attachments[self._name] = self._previous_size + size
+        return self._is_attachment_line(line)
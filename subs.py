@@ -1,19 +1,30 @@
+import base64
 import codecs
+import io
+import itertools
+import json
+import multiprocessing
 import os
 import bisect
 import re
 import copy
 import logging
-from collections import OrderedDict
+import math
+from operator import attrgetter
+import tempfile
+from collections import OrderedDict, deque
 try:
     import webcolors
 except:
     webcolors = None
 
-from tools import Timecodes
+from tools import Timecodes, IntervalIndex, is_sorted, merge_sorted
 from common import PrassError, zip, map, itervalues, iterkeys, iteritems, py2_unicode_compatible
 
 
+BINARY_MAGIC = b"PRASS\x00BIN"
+BINARY_FORMAT_VERSION = 2
+
 STYLES_SECTION = u"[V4+ Styles]"
 EVENTS_SECTION = u"[Events]"
 SCRIPT_INFO_SECTION = u"[Script Info]"
@@ -24,6 +35,16 @@ def parse_ass_time(string):
     return hours * 3600000 + minutes * 60000 + seconds * 1000 + centiseconds * 10
 
 
+def parse_margin(string):
+    """Parse an event margin, an empty one means zero like in renderers"""
+    if not string.strip():
+        return 0
+    try:
+        return int(string)
+    except ValueError:
+        raise PrassError(u"Invalid event margin: {0}".format(string))
+
+
 def parse_srt_time(string):
     hours, minutes, seconds, milliseconds = map(int, re.match(r"(\d+):(\d+):(\d+)\,(\d+)", string).groups())
     return hours * 3600000 + minutes * 60000 + seconds * 1000 + milliseconds
@@ -47,6 +68,58 @@ def srt_line_to_ass(line, box=False):
         line = line.replace('</font>', '{\c&HFFFFFF&}')
     return line
 
+OVERRIDE_BLOCK = re.compile(r"({[^{}]*})")
+
+
+def strip_tags(text):
+    return OVERRIDE_BLOCK.sub(u"", text)
+
+
+def ass_line_to_html(text, tags=(u'i', u'b', u'u', u's'), escape=False):
+    """Convert ASS event text to plain text with simple html formatting, as used by SRT and WebVTT.
+    Override tags other than the ones in tags are dropped, as are vector drawings."""
+    result = []
+    opened = []
+    drawing = False
+    for idx, part in enumerate(OVERRIDE_BLOCK.split(text)):
+        if idx % 2:
+            for tag, value in re.findall(r"\\(r|p|[ibus])(\d*)", part):
+                if tag == u'p':
+                    if value:
+                        drawing = value.strip(u"0") != u""
+                elif tag == u'r':
+                    result.extend(u"</%s>" % x for x in reversed(opened))
+                    opened = []
+                elif tag not in tags or not value:
+                    continue
+                elif value != u"0" and tag not in opened:
+                    opened.append(tag)
+                    result.append(u"<%s>" % tag)
+                elif value == u"0" and tag in opened:
+                    opened.remove(tag)
+                    result.append(u"</%s>" % tag)
+        elif part and not drawing:
+            if escape:
+                part = part.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+            result.append(part.replace(u"\\N", u"\n").replace(u"\\n", u" ").replace(u"\\h", u"\u00a0"))
+    result.extend(u"</%s>" % x for x in reversed(opened))
+    text = re.sub(r"<([ibus])></\1>", u"", u"".join(result))
+    # empty lines would end the cue
+    return re.sub(r"\s*\n\s*", u"\n", text).strip()
+
+
+def count_characters(text):
+    """Number of visible characters in event text, ignoring override tags, line breaks and whitespace"""
+    text = strip_tags(text).replace(u"\\N", u"").replace(u"\\n", u"").replace(u"\\h", u"")
+    return len(text) - sum(1 for x in text if x.isspace())
+
+
+def format_srt_time(ms, separator=u','):
+    ms = int(round(ms))
+    return u'{0:02d}:{1:02d}:{2:02d}{3}{4:03d}'.format(ms // 3600000, (ms // 60000) % 60, (ms // 1000) % 60,
+                                                       separator, ms % 1000)
+
+
 def format_time(ms):
     cs = int(ms / 10.0)
     return u'{0}:{1:02d}:{2:02d}.{3:02d}'.format(
@@ -56,6 +129,123 @@ def format_time(ms):
             int(cs % 100))
 
 
+def get_horizontal_stretch(from_width, from_height, to_width, to_height):
+    old_ar = from_width / float(from_height)
+    new_ar = to_width / float(to_height)
+    if abs(old_ar - new_ar) / new_ar > 0.01:
+        return new_ar / old_ar
+    return 1.0
+
+
+def format_number(value):
+    text = (u"%.3f" % value).rstrip(u"0").rstrip(u".")
+    return u"0" if text == u"-0" else text
+
+
+class OverrideTagsResampler(object):
+    """Rescales coordinates and sizes in override tags and drawings of event text.
+    Instances are picklable so they can be mapped over chunks of events in a process pool."""
+    TAGS = re.compile(r"\\(pos|org|move|i?clip)\(([^()]*)\)"
+                      r"|\\(fsp|fscx|fs|xbord|ybord|bord|xshad|yshad|shad|blur|pbo|p)(-?\d+(?:\.\d*)?|-?\.\d+)")
+    NUMBER = re.compile(r"-?\d+(?:\.\d*)?|-?\.\d+")
+
+    def __init__(self, scale_x, scale_y, horizontal_stretch, scale_border_and_shadow):
+        self.scale_x = scale_x
+        self.scale_y = scale_y
+        self.border_x = scale_x if scale_border_and_shadow else 1.0
+        self.border_y = scale_y if scale_border_and_shadow else 1.0
+        self.scalars = {
+            'fs': scale_y, 'fsp': scale_x, 'fscx': horizontal_stretch, 'blur': self.border_y, 'pbo': scale_y,
+            'bord': self.border_y, 'xbord': self.border_x, 'ybord': self.border_y,
+            'shad': self.border_y, 'xshad': self.border_x, 'yshad': self.border_y,
+        }
+
+    def _scale_coordinates(self, values):
+        return [format_number(float(v) * (self.scale_y if i % 2 else self.scale_x)) for i, v in enumerate(values)]
+
+    def _scale_drawing(self, drawing):
+        counter = [0]
+
+        def scale(match):
+            scale = self.scale_y if counter[0] % 2 else self.scale_x
+            counter[0] += 1
+            return format_number(float(match.group(0)) * scale)
+        return self.NUMBER.sub(scale, drawing)
+
+    def _replace_tag(self, match):
+        name, args, scalar, value = match.groups()
+        if scalar:
+            if scalar == 'p':
+                self._drawing = value.strip(u"0.") != u""
+                return match.group(0)
+            return u"\\%s%s" % (scalar, format_number(float(value) * self.scalars[scalar]))
+
+        args = [x.strip() for x in args.split(u",")]
+        if name in ('clip', 'iclip') and len(args) != 4:
+            args[-1] = self._scale_drawing(args[-1])
+        elif name == 'move':
+            args[:4] = self._scale_coordinates(args[:4])
+        else:
+            args = self._scale_coordinates(args)
+        return u"\\%s(%s)" % (name, u",".join(args))
+
+    def __call__(self, text):
+        if u"{" not in text:
+            return text
+        self._drawing = False
+        parts = OVERRIDE_BLOCK.split(text)
+        for idx, part in enumerate(parts):
+            if idx % 2:
+                parts[idx] = self.TAGS.sub(self._replace_tag, part)
+            elif self._drawing and part:
+                parts[idx] = self._scale_drawing(part)
+        return u"".join(parts)
+
+
+class TimingTagsScaler(object):
+    """Multiplies times in karaoke, \\t, \\move and \\fad(e) tags of event text.
+    Text without anything looking like these tags is returned untouched after a single search."""
+    PRECHECK = re.compile(r"\\(?:[kK]|t\(|move|fad)")
+    TAGS = re.compile(r"\\(k[fo]?|K)(\d+(?:\.\d*)?)"
+                      r"|\\t\(\s*(-?\d+(?:\.\d*)?)\s*,\s*(-?\d+(?:\.\d*)?)\s*(?=,)"
+                      r"|\\(move|fade?)\(([^()]*)\)")
+    # indexes of time arguments by tag and number of arguments
+    TIME_ARGUMENTS = {('move', 6): slice(4, 6), ('fad', 2): slice(0, 2), ('fade', 2): slice(0, 2), ('fade', 7): slice(3, 7)}
+
+    def __init__(self, multiplier):
+        self.multiplier = multiplier
+
+    def _scale(self, value):
+        return u"%d" % int(round(float(value) * self.multiplier))
+
+    def _replace_tag(self, match):
+        karaoke, duration, t1, t2, name, args = match.groups()
+        if karaoke:
+            # rounding the running total keeps syllables in sync with the scaled event times
+            self._karaoke_total += float(duration)
+            end = int(round(self._karaoke_total * self.multiplier))
+            duration, self._karaoke_end = end - self._karaoke_end, end
+            return u"\\%s%d" % (karaoke, duration)
+        if t1 is not None:
+            return u"\\t(%s,%s" % (self._scale(t1), self._scale(t2))
+        args = [x.strip() for x in args.split(u",")]
+        times = self.TIME_ARGUMENTS.get((name, len(args)))
+        if times is None:
+            return match.group(0)
+        args[times] = [self._scale(x) for x in args[times]]
+        return u"\\%s(%s)" % (name, u",".join(args))
+
+    def __call__(self, text):
+        if u"{" not in text or not self.PRECHECK.search(text):
+            return text
+        self._karaoke_total = 0
+        self._karaoke_end = 0
+        parts = OVERRIDE_BLOCK.split(text)
+        for idx in range(1, len(parts), 2):
+            parts[idx] = self.TAGS.sub(self._replace_tag, parts[idx])
+        return u"".join(parts)
+
+
 class AssStyle(object):
     def __init__(self, name, definition):
         self.name = name
@@ -69,11 +259,7 @@ class AssStyle(object):
     def resample(self, from_width, from_height, to_width, to_height, scale_border_and_shadow=True):
         scale_height = to_height / float(from_height)
         scale_width = to_width / float(from_width)
-        old_ar = from_width / float(from_height)
-        new_ar = to_width / float(to_height)
-        horizontal_stretch = 1.0
-        if abs(old_ar - new_ar) / new_ar > 0.01:
-            horizontal_stretch = new_ar / old_ar
+        horizontal_stretch = get_horizontal_stretch(from_width, from_height, to_width, to_height)
 
         parts = self.definition.split(",")
         parts[1] = "%i" % (round(int(parts[1]) * scale_height))  # font size
@@ -120,23 +306,39 @@ class AssEvent(object):
         self.text = text
 
     @classmethod
-    def from_text(cls, text):
+    def from_text(cls, text, strings=None):
+        """Parse an event line. If a strings dict is provided, kind, style, actor and effect values
+        are shared through it so that repeated values are stored only once."""
         kind, _, rest = text.partition(u":")
         split = [x.strip() for x in rest.split(',', 9)]
+        if strings is None:
+            strings = {}
         return cls(
-            kind=kind,
+            kind=strings.setdefault(kind, kind),
             layer=int(split[0]),
             start=parse_ass_time(split[1]),
             end=parse_ass_time(split[2]),
-            style=split[3],
-            actor=split[4],
-            margin_left=split[5],
-            margin_right=split[6],
-            margin_vertical=split[7],
-            effect=split[8],
+            style=strings.setdefault(split[3], split[3]),
+            actor=strings.setdefault(split[4], split[4]),
+            margin_left=parse_margin(split[5]),
+            margin_right=parse_margin(split[6]),
+            margin_vertical=parse_margin(split[7]),
+            effect=strings.setdefault(split[8], split[8]),
             text=split[9]
         )
 
+    @classmethod
+    def from_record(cls, record, strings):
+        start, end, text, kind, layer, style, actor, margin_left, margin_right, margin_vertical, effect = record
+        return cls(start, end, text, strings.setdefault(kind, kind), layer, strings.setdefault(style, style),
+                   strings.setdefault(actor, actor), margin_left, margin_right, margin_vertical,
+                   strings.setdefault(effect, effect))
+
+    def to_record(self):
+        """Plain tuple of event fields, cheap to serialize or pickle"""
+        return (self.start, self.end, self.text, self.kind, self.layer, self.style, self.actor,
+                self.margin_left, self.margin_right, self.margin_vertical, self.effect)
+
     def __str__(self):
         return u'{0}: {1},{2},{3},{4},{5},{6},{7},{8},{9},{10}'.format(self.kind, self.layer,
                                                                        format_time(self.start),
@@ -175,16 +377,142 @@ class StylesSection(object):
 class EventsSection(object):
     def __init__(self):
         self.events = []
+        self._strings = {}
 
     def parse_line(self, text):
         if text.startswith(u'Format:'):
             return
-        self.events.append(AssEvent.from_text(text))
+        self.add_event(AssEvent.from_text(text, self._strings))
+
+    def add_event(self, event):
+        self.events.append(event)
 
     def format_section(self):
-        lines = [u'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text']
-        lines.extend(u"%s" % x for x in self.events)
-        return lines
+        yield u'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text'
+        for event in self.events:
+            yield u"%s" % event
+
+
+class UnloadedEventsSection(EventsSection):
+    """Events section that doesn't keep its events, only remembers whether they are sorted by start time.
+    Events can be provided later by assigning any iterable to the events attribute."""
+    def __init__(self):
+        super(UnloadedEventsSection, self).__init__()
+        self.sorted_by_start = True
+        self._last_start = None
+
+    def parse_line(self, text):
+        if text.startswith(u'Format:'):
+            return
+        self._check_start(parse_ass_time(text.split(u',', 2)[1]))
+
+    def add_event(self, event):
+        self._check_start(event.start)
+
+    def _check_start(self, start):
+        if self._last_start is not None and start < self._last_start:
+            self.sorted_by_start = False
+        self._last_start = start
+
+
+class WindowEventsSection(EventsSection):
+    """Events section that only keeps events intersecting with [start, end).
+    Times of other events are parsed without building the events, and if events are known to be sorted
+    by start time, nothing is parsed at all after the end of the window."""
+    def __init__(self, start, end, assume_sorted=False):
+        super(WindowEventsSection, self).__init__()
+        self._start = start
+        self._end = end
+        self._assume_sorted = assume_sorted
+        self._finished = False
+
+    def parse_line(self, text):
+        if self._finished or text.startswith(u'Format:'):
+            return
+        _, start, end, _ = text.split(u',', 3)
+        if self._in_window(parse_ass_time(start), lambda: parse_ass_time(end)):
+            EventsSection.parse_line(self, text)
+
+    def add_event(self, event):
+        if not self._finished and self._in_window(event.start, lambda: event.end):
+            EventsSection.add_event(self, event)
+
+    def _in_window(self, start, get_end):
+        if start >= self._end:
+            self._finished = self._assume_sorted
+            return False
+        return start >= self._start or get_end() > self._start
+
+
+class ExternalSortEventsSection(object):
+    """Events section that keeps at most buffer_size events in memory.
+    Sorted runs are spilled to temporary files and merged back when the section is formatted,
+    so the events can only be iterated once."""
+    def __init__(self, key, descending, buffer_size):
+        self._key = key
+        self._descending = descending
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._runs = []
+        self._run_sorted = True
+        self._presorted = True
+        self._last_key = None
+        self._strings = {}
+
+    def parse_line(self, text):
+        if text.startswith(u'Format:'):
+            return
+        self.add_event(AssEvent.from_text(text, self._strings))
+
+    def add_event(self, event):
+        key = self._key(event)
+        if self._last_key is not None and ((key > self._last_key) if self._descending else (key < self._last_key)):
+            self._presorted = False
+            if self._buffer:
+                self._run_sorted = False
+        self._last_key = key
+        self._buffer.append(event)
+        if len(self._buffer) >= self._buffer_size:
+            self._spill()
+
+    def _sort_buffer(self):
+        if not self._run_sorted:
+            self._buffer.sort(key=self._key, reverse=self._descending)
+        self._run_sorted = True
+
+    def _spill(self):
+        self._sort_buffer()
+        run = tempfile.TemporaryFile()
+        for event in self._buffer:
+            run.write((u"%s\n" % event).encode('utf-8'))
+        self._runs.append(run)
+        self._buffer = []
+
+    def _read_run(self, run):
+        run.seek(0)
+        try:
+            for line in run:
+                yield AssEvent.from_text(line.decode('utf-8').rstrip(u'\n'), self._strings)
+        finally:
+            run.close()
+
+    @property
+    def events(self):
+        if not self._runs:
+            self._sort_buffer()
+            return iter(self._buffer)
+        if self._buffer:
+            self._spill()
+        runs = [self._read_run(run) for run in self._runs]
+        self._runs = []
+        if self._presorted:
+            return (event for run in runs for event in run)
+        return merge_sorted(runs, self._key, self._descending)
+
+    def format_section(self):
+        yield u'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text'
+        for event in self.events:
+            yield u"%s" % event
 
 
 class ScriptInfoSection(object):
@@ -258,17 +586,294 @@ class GenericSection(object):
 
 
 class AttachmentSection(GenericSection):
+    # ASS uses the same bit layout as base64 with the alphabet starting at "!", so decoding is a translation away
+    DECODING_TABLE = dict((33 + idx, ord(char)) for idx, char in
+                          enumerate(u"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"))
+
+    @classmethod
+    def _decode(cls, data):
+        data = data.translate(cls.DECODING_TABLE).encode('ascii')
+        return base64.b64decode(data + b"=" * (-len(data) % 4))
+
+    def iter_attachments(self):
+        """Decode attachments line by line, yielding (filename, data) pairs"""
+        name, data, leftover = None, None, u""
+        for line in self.lines:
+            if line.startswith(u"fontname: ") or line.startswith(u"filename: "):
+                if name is not None:
+                    data.extend(self._decode(leftover))
+                    yield name, bytes(data)
+                name, data, leftover = line.partition(u": ")[2], bytearray(), u""
+            elif name is not None:
+                line = leftover + line
+                complete = len(line) - len(line) % 4
+                data.extend(self._decode(line[:complete]))
+                leftover = line[complete:]
+        if name is not None:
+            data.extend(self._decode(leftover))
+            yield name, bytes(data)
+
     def parse_line(self, line):
         if not line:
             return False
         self.lines.append(line)
+        return self._is_attachment_line(line)
 
+    @staticmethod
+    def _is_attachment_line(line):
         # as usual, copied from aegisub
         is_valid = 0 < len(line) <= 80 #and all(33 <= ord(x) < 97 for x in line)
         is_filename = line.startswith("fontname: ") or line.startswith("filename: ")
         return is_valid or is_filename
 
 
+def _parse_events_chunk(chunk):
+    records = []
+    strings = {}
+    for line in chunk.decode('utf-8').splitlines():
+        line = line.strip()
+        if line and not line.startswith(u'Format:'):
+            records.append(AssEvent.from_text(line, strings).to_record())
+    return records
+
+
+def iter_ass_events(file_object):
+    """Lazily parse events of an ASS stream, skipping every other section"""
+    in_events = False
+    strings = {}
+    for line in file_object:
+        line = line.strip()
+        if line.startswith(u'[') and line.endswith(u']'):
+            # uuencoded attachment data can't contain lowercase letters so it never looks like [Events]
+            in_events = line.lower() == u'[events]'
+        elif in_events and line and not line.startswith(u'Format:'):
+            yield AssEvent.from_text(line, strings)
+
+
+def iter_ass_file_events(path):
+    try:
+        with codecs.open(path, encoding='utf-8-sig') as script:
+            for event in iter_ass_events(script):
+                yield event
+    except IOError:
+        raise PrassError("Script {0} not found".format(path))
+
+
+class EventMatcher(object):
+    """Compiled search pattern with optional restrictions on style, actor and layer of events.
+    Instances are picklable so they can be sent to worker processes."""
+    def __init__(self, pattern, styles=None, actors=None, layers=None, ignore_tags=False, ignore_case=False):
+        self.regex = re.compile(pattern, re.UNICODE | (re.IGNORECASE if ignore_case else 0))
+        self.styles = set(s.lower() for s in styles) if styles else None
+        self.actors = set(actors) if actors else None
+        self.layers = set(layers) if layers else None
+        self.ignore_tags = ignore_tags
+
+    def accepts(self, event):
+        return (self.styles is None or event.style.lower() in self.styles) and \
+               (self.actors is None or event.actor in self.actors) and \
+               (self.layers is None or event.layer in self.layers)
+
+    def search(self, event):
+        if not self.accepts(event):
+            return False
+        return self.regex.search(strip_tags(event.text) if self.ignore_tags else event.text) is not None
+
+    def check_replacement(self, replacement):
+        """Raise re.error (or IndexError on older pythons) if replacement isn't a valid template for the pattern"""
+        names = dict((idx, name) for name, idx in iteritems(self.regex.groupindex))
+        groups = u"".join(u"(?P<%s>)" % names[idx] if idx in names else u"()"
+                          for idx in range(1, self.regex.groups + 1))
+        # a pattern with the same groups that matches the empty string expands the template once
+        re.compile(groups).sub(replacement, u"")
+
+    def sub(self, replacement, event):
+        """Replace all matches in event text, returning the number of replacements"""
+        if not self.accepts(event):
+            return 0
+        if not self.ignore_tags:
+            event.text, count = self.regex.subn(replacement, event.text)
+            return count
+        parts = OVERRIDE_BLOCK.split(event.text)
+        total = 0
+        for idx in range(0, len(parts), 2):
+            parts[idx], count = self.regex.subn(replacement, parts[idx])
+            total += count
+        if total:
+            event.text = u"".join(parts)
+        return total
+
+
+class EventTransform(object):
+    """User Python code applied to every event, compiled once.
+    Plain statements see event fields as variables and can assign them,
+    a file has to define transform(event) which changes the event in place.
+    Instances are picklable so they can be sent to worker processes."""
+    FIELDS = AssEvent.__slots__
+
+    def __init__(self, source, path=None):
+        self.source = source
+        self.path = path
+        self._compile()
+
+    def _compile(self):
+        try:
+            code = compile(self.source, self.path or u'<expression>', 'exec')
+        except SyntaxError as e:
+            raise PrassError(u"Invalid transform: {0}".format(e))
+        self._globals = {'__name__': '__prass_map__', 're': re, 'strip_tags': strip_tags}
+        self._code = None
+        self._function = None
+        if self.path:
+            exec(code, self._globals)
+            self._function = self._globals.get('transform')
+            if not callable(self._function):
+                raise PrassError(u"{0} doesn't define a transform(event) function".format(self.path))
+        else:
+            self._code = code
+
+    def __getstate__(self):
+        return self.source, self.path
+
+    def __setstate__(self, state):
+        self.source, self.path = state
+        self._compile()
+
+    def __call__(self, event):
+        try:
+            if self._function:
+                self._function(event)
+                return
+            namespace = dict(self._globals)
+            for field in self.FIELDS:
+                namespace[field] = getattr(event, field)
+            exec(self._code, namespace)
+            for field in self.FIELDS:
+                setattr(event, field, namespace[field])
+        except Exception as e:
+            raise PrassError(u"Transform failed on event {0}: {1!r}".format(event, e))
+
+
+def diff_events(old_events, new_events, time_tolerance):
+    """Match events of two scripts and return a list of (change, old, new) tuples, where change is one of
+    'added', 'removed', 'retimed', 'retexted' or 'modified'. Events are matched by exact line, then by text,
+    then by text without override tags and finally by start time proximity, so the whole thing is O(n log n)."""
+    def match(old_list, new_list, key):
+        candidates = {}
+        for event in old_list:
+            candidates.setdefault(key(event), deque()).append(event)
+        pairs, new_left = [], []
+        for event in new_list:
+            found = candidates.get(key(event))
+            if found:
+                pairs.append((found.popleft(), event))
+            else:
+                new_left.append(event)
+        old_left = [e for queue in itervalues(candidates) for e in queue]
+        old_left.sort(key=lambda x: x.start)
+        return pairs, old_left, new_left
+
+    old_list = sorted(old_events, key=lambda x: x.start)
+    new_list = sorted(new_events, key=lambda x: x.start)
+    matched = []
+    for key in (lambda x: u"%s" % x, lambda x: x.text, lambda x: strip_tags(x.text)):
+        pairs, old_list, new_list = match(old_list, new_list, key)
+        matched.extend(pairs)
+
+    old_left, new_left = [], []
+    old_idx = new_idx = 0
+    while old_idx < len(old_list) and new_idx < len(new_list):
+        old, new = old_list[old_idx], new_list[new_idx]
+        if abs(old.start - new.start) <= time_tolerance:
+            matched.append((old, new))
+            old_idx += 1
+            new_idx += 1
+        elif old.start < new.start:
+            old_left.append(old)
+            old_idx += 1
+        else:
+            new_left.append(new)
+            new_idx += 1
+    old_left.extend(old_list[old_idx:])
+    new_left.extend(new_list[new_idx:])
+
+    other_fields = attrgetter('kind', 'layer', 'style', 'actor', 'margin_left', 'margin_right',
+                              'margin_vertical', 'effect')
+    changes = []
+    for old, new in matched:
+        same_times = old.start == new.start and old.end == new.end
+        same_text = old.text == new.text
+        if other_fields(old) != other_fields(new):
+            changes.append(('modified', old, new))
+        elif not same_times and same_text:
+            changes.append(('retimed', old, new))
+        elif same_times and not same_text:
+            changes.append(('retexted', old, new))
+        elif not same_times:
+            changes.append(('modified', old, new))
+    changes.extend(('removed', e, None) for e in old_left)
+    changes.extend(('added', None, e) for e in new_left)
+    changes.sort(key=lambda x: (x[2] or x[1]).start)
+    return changes
+
+
+def decode_ass_lines(head, file_object):
+    """Lazily decode lines of a plain ASS binary stream, head being the bytes already read from it"""
+    first_lines = (head + file_object.readline()).splitlines(True)
+    lines = (line.decode('utf-8') for line in itertools.chain(first_lines, file_object))
+    first = next(lines, u"").lstrip(u"\ufeff")
+    return itertools.chain([first], lines)
+
+
+class AssParser(object):
+    """Incremental ASS parser, lines can be fed one by one from any source"""
+    def __init__(self, events_section_factory=EventsSection, attachment_section_factory=AttachmentSection):
+        super(AssParser, self).__init__()
+        self.sections = []
+        self._events_section_factory = events_section_factory
+        self._attachment_section_factory = attachment_section_factory
+        self._current_section = None
+        self._force_last_section = False
+        self._idx = 0
+
+    def parse_line(self, line):
+        idx = self._idx
+        self._idx += 1
+        line = line.strip()
+        # required because a line might be both a part of an attachment and a valid header
+        if self._force_last_section:
+            try:
+                self._force_last_section = self._current_section.parse_line(line)
+                return
+            except Exception as e:
+                raise PrassError(u"That's some invalid ASS script: {0}".format(e))
+
+        if not line:
+            return
+        low = line.lower()
+        if low == u'[v4+ styles]':
+            self._start_section(line, StylesSection())
+        elif low == u'[events]':
+            self._start_section(line, self._events_section_factory())
+        elif low == u'[script info]':
+            self._start_section(line, ScriptInfoSection())
+        elif low == u'[graphics]' or low == u'[fonts]':
+            self._start_section(line, self._attachment_section_factory())
+        elif re.match(r'^\s*\[.+?\]\s*$', low):
+            self._start_section(line, GenericSection())
+        elif not self._current_section:
+            raise PrassError(u"That's some invalid ASS script (no parse function at line {0})".format(idx))
+        else:
+            try:
+                self._force_last_section = self._current_section.parse_line(line)
+            except Exception as e:
+                raise PrassError(u"That's some invalid ASS script: {0}".format(e))
+
+    def _start_section(self, name, section):
+        self._current_section = section
+        self.sections.append((name, section))
+
+
 class AssScript(object):
     def __init__(self, sections_list):
         super(AssScript, self).__init__()
@@ -290,55 +895,151 @@ class AssScript(object):
         return next((section for section_name, section in self._sections_list if section_name == name), None)
 
     @classmethod
-    def from_ass_stream(cls, file_object):
-        sections = []
-        current_section = None
-        force_last_section = False
-        for idx, line in enumerate(file_object):
-            line = line.strip()
-            # required because a line might be both a part of an attachment and a valid header
-            if force_last_section:
-                try:
-                    force_last_section = current_section.parse_line(line)
-                    continue
-                except Exception as e:
-                    raise PrassError(u"That's some invalid ASS script: {0}".format(e.message))
-
-            if not line:
-                continue
-            low = line.lower()
-            if low == u'[v4+ styles]':
-                current_section = StylesSection()
-                sections.append((line, current_section))
-            elif low == u'[events]':
-                current_section = EventsSection()
-                sections.append((line, current_section))
-            elif low == u'[script info]':
-                current_section = ScriptInfoSection()
-                sections.append((line, current_section))
-            elif low == u'[graphics]' or low == u'[fonts]':
-                current_section = AttachmentSection()
-                sections.append((line, current_section))
-            elif re.match(r'^\s*\[.+?\]\s*$', low):
-                current_section = GenericSection()
-                sections.append((line, current_section))
-            elif not current_section:
-                raise PrassError(u"That's some invalid ASS script (no parse function at line {0})".format(idx))
-            else:
-                try:
-                    force_last_section = current_section.parse_line(line)
-                except Exception as e:
-                    raise PrassError(u"That's some invalid ASS script: {0}".format(e.message))
-        return cls(sections)
+    def from_ass_stream(cls, file_object, events_section_factory=EventsSection):
+        parser = AssParser(events_section_factory)
+        for line in file_object:
+            parser.parse_line(line)
+        return cls(parser.sections)
 
     @classmethod
-    def from_ass_file(cls, path):
+    def from_ass_file(cls, path, events_section_factory=EventsSection, jobs=1):
+        """Load script from a file. With more than one job, the events section is split into chunks
+        on line boundaries which are parsed in a process pool, everything else is parsed as usual."""
         try:
+            if jobs > 1:
+                with open(path, 'rb') as script:
+                    return cls._from_ass_bytes_parallel(script.read(), events_section_factory, jobs)
             with codecs.open(path, encoding='utf-8-sig') as script:
-                return cls.from_ass_stream(script)
+                return cls.from_ass_stream(script, events_section_factory)
         except IOError:
             raise PrassError("Script {0} not found".format(path))
 
+    @classmethod
+    def _from_ass_bytes_parallel(cls, data, events_section_factory, jobs):
+        if data.startswith(BINARY_MAGIC):
+            return cls.from_binary_stream(io.BytesIO(data[len(BINARY_MAGIC):]), events_section_factory)
+        header = re.search(br"^[ \t]*\[events\][ \t]*\r?$", data, re.IGNORECASE | re.MULTILINE)
+        if not header:
+            return cls.from_ass_stream(data.decode('utf-8-sig').splitlines(), events_section_factory)
+        events_start = min(header.end() + 1, len(data))
+        next_section = re.compile(br"^[ \t]*\[", re.MULTILINE).search(data, events_start)
+        events_end = next_section.start() if next_section else len(data)
+
+        chunk_size = max(1, (events_end - events_start) // (jobs * 4))
+        chunks = []
+        position = events_start
+        while position < events_end:
+            end = data.find(b"\n", min(position + chunk_size, events_end - 1), events_end)
+            end = events_end if end == -1 else end + 1
+            chunks.append(data[position:end])
+            position = end
+
+        text = (data[:events_start] + data[events_end:]).decode('utf-8-sig')
+        script = cls.from_ass_stream(text.splitlines(), events_section_factory)
+        section = next(x for name, x in script._sections_list if name.lower() == u'[events]')
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            strings = {}
+            for records in pool.imap(_parse_events_chunk, chunks):
+                for record in records:
+                    section.add_event(AssEvent.from_record(record, strings))
+        finally:
+            pool.close()
+        return script
+
+    @classmethod
+    def from_sorted_ass_file_window(cls, path, start, end):
+        """Load a script sorted by start time with only events intersecting [start, end).
+        The first event starting after the window and the end of the events section are found by binary search
+        over byte offsets, so events after the window are never read. Events before it still have to be scanned,
+        since any of them might be long enough to reach into the window."""
+        window_section = lambda: WindowEventsSection(start, end, assume_sorted=True)
+        with open(path, 'rb') as script:
+            header = []
+            for line in iter(script.readline, b''):
+                header.append(line)
+                if line.strip().lower() == b'[events]':
+                    break
+            if not header or header[0].startswith(BINARY_MAGIC) or header[-1].strip().lower() != b'[events]':
+                script.seek(0)
+                return cls.from_stream(script, window_section)
+            events_start = script.tell()
+            size = os.fstat(script.fileno()).st_size
+
+            def first_line_at(offset):
+                # offset and start time of the first line starting at or after offset, None when it's not an event
+                script.seek(max(offset - 1, 0))
+                if offset > 0:
+                    script.readline()
+                while True:
+                    position, line = script.tell(), script.readline()
+                    stripped = line.strip()
+                    if not line or not (not stripped or stripped.startswith(b'Format:')):
+                        break
+                if stripped.startswith(b'Dialogue:') or stripped.startswith(b'Comment:'):
+                    return position, parse_ass_time(stripped.split(b',', 2)[1].decode('ascii'))
+                return position, None
+
+            def bisect_offsets(low, high, predicate):
+                while low < high:
+                    middle = (low + high) // 2
+                    if predicate(first_line_at(middle)[1]):
+                        high = middle
+                    else:
+                        low = middle + 1
+                return first_line_at(low)[0]
+
+            window_end = bisect_offsets(events_start, size, lambda x: x is None or x >= end)
+            events_end = bisect_offsets(window_end, size, lambda x: x is None)
+            script.seek(events_start)
+            events = script.read(window_end - events_start)
+            script.seek(events_end)
+            text = (b"".join(header) + events + script.read()).decode('utf-8-sig')
+        return cls.from_ass_stream(text.splitlines(), window_section)
+
+    @classmethod
+    def from_binary_stream(cls, file_object, events_section_factory=EventsSection):
+        version = bytearray(file_object.read(1))
+        if version != bytearray([BINARY_FORMAT_VERSION]):
+            raise PrassError(u"Unsupported binary script format version {0}, expected {1}".format(
+                version[0] if version else None, BINARY_FORMAT_VERSION))
+        try:
+            return cls._from_binary_payload(json.loads(file_object.read().decode('utf-8')), events_section_factory)
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            raise PrassError(u"Binary script is corrupted: {0}".format(e))
+
+    @classmethod
+    def _from_binary_payload(cls, payload_sections, events_section_factory):
+        sections = []
+        for name, kind, payload in payload_sections:
+            if kind == 'info':
+                section = ScriptInfoSection()
+                for prop_name, value in payload:
+                    section._lines_dict[prop_name] = ScriptInfoSection.PropertyLine(prop_name, value)
+            elif kind == 'styles':
+                section = StylesSection()
+                for style_name, definition in payload:
+                    section.styles[style_name] = AssStyle(style_name, definition)
+            elif kind == 'events':
+                section = events_section_factory()
+                strings = {}
+                for record in payload:
+                    section.add_event(AssEvent.from_record(record, strings))
+            else:
+                section = AttachmentSection() if kind == 'attachment' else GenericSection()
+                section.lines = list(payload)
+            sections.append((name, section))
+        return cls(sections)
+
+    @classmethod
+    def from_stream(cls, file_object, events_section_factory=EventsSection):
+        """Load a script from a binary stream, either in plain ASS or in the binary pipe format"""
+        head = file_object.read(len(BINARY_MAGIC))
+        if head == BINARY_MAGIC:
+            return cls.from_binary_stream(file_object, events_section_factory)
+        return cls.from_ass_stream(decode_ass_lines(head, file_object), events_section_factory)
+
     @classmethod
     def from_srt_stream(cls, file_object):
         styles_section = StylesSection()
@@ -369,14 +1070,85 @@ class AssScript(object):
             (EVENTS_SECTION, events_section),
         ])
 
+    @classmethod
+    def merge_files(cls, paths, on_conflict, resample, forced_resolution=None):
+        scripts = [cls.from_ass_file(path, UnloadedEventsSection) for path in paths]
+        result = scripts[0]
+        if result._find_section(EVENTS_SECTION) is None:
+            result._sections_list.append((EVENTS_SECTION, EventsSection()))
+        if resample and forced_resolution:
+            result.scale_to_reference(result, forced_resolution)
+        for script in scripts[1:]:
+            result.append_styles(script, False, resample, on_conflict=on_conflict)
+
+        start_getter = lambda x: x.start
+        sources = []
+        for path, script in zip(paths, scripts):
+            section = script._find_section(EVENTS_SECTION)
+            if section is None:
+                continue
+            if section.sorted_by_start:
+                # events are read again lazily, only one event per script is kept in memory
+                sources.append(iter_ass_file_events(path))
+            else:
+                sources.append(sorted(iter_ass_file_events(path), key=start_getter))
+
+        result._events = merge_sorted(sources, start_getter)
+        return result
+
+    def iter_ass_lines(self):
+        # produced section by section so that lazily produced events never have to be materialized
+        for idx, (name, section) in enumerate(self._sections_list):
+            if idx:
+                yield u""
+            yield name
+            for line in section.format_section():
+                yield line
+
     def to_ass_stream(self, file_object):
-        lines = []
-        for name, section in self._sections_list:
-            lines.append(name)
-            lines.extend(section.format_section())
-            lines.append(u"")
+        for line in self.iter_ass_lines():
+            file_object.write(u"%s\n" % line)
 
-        file_object.write("\n".join(lines))
+    def to_binary_stream(self, file_object):
+        """Write the script in a compact format meant only for passing it between prass processes.
+        It's versioned JSON after a magic header, so it doesn't depend on the python version."""
+        sections = []
+        for name, section in self._sections_list:
+            if isinstance(section, ScriptInfoSection):
+                kind, payload = 'info', [(x.name, x.value) for x in itervalues(section._lines_dict)]
+            elif isinstance(section, StylesSection):
+                kind, payload = 'styles', [(x.name, x.definition) for x in itervalues(section.styles)]
+            elif isinstance(section, AttachmentSection):
+                kind, payload = 'attachment', section.lines
+            elif isinstance(section, GenericSection):
+                kind, payload = 'generic', section.lines
+            else:
+                kind, payload = 'events', [e.to_record() for e in section.events]
+            sections.append((name, kind, payload))
+        file_object.write(BINARY_MAGIC + bytes(bytearray([BINARY_FORMAT_VERSION])))
+        payload = json.dumps(sections, ensure_ascii=False, separators=(',', ':'))
+        file_object.write(payload.encode('utf-8'))
+
+    def _text_events(self):
+        events = sorted((e for e in self._events if not e.is_comment), key=lambda x: x.start)
+        return (e for e in events if e.end > e.start)
+
+    def to_srt_stream(self, file_object):
+        idx = 0
+        for event in self._text_events():
+            text = ass_line_to_html(event.text)
+            if text:
+                idx += 1
+                file_object.write(u"{0}\n{1} --> {2}\n{3}\n\n".format(
+                    idx, format_srt_time(event.start), format_srt_time(event.end), text))
+
+    def to_vtt_stream(self, file_object):
+        file_object.write(u"WEBVTT\n\n")
+        for event in self._text_events():
+            text = ass_line_to_html(event.text, tags=(u'i', u'b', u'u'), escape=True)
+            if text:
+                file_object.write(u"{0} --> {1}\n{2}\n\n".format(
+                    format_srt_time(event.start, u'.'), format_srt_time(event.end, u'.'), text))
 
     def to_ass_file(self, path):
         with codecs.open(path, encoding='utf-8-sig', mode='w') as script:
@@ -396,7 +1168,42 @@ class AssScript(object):
         else:
             logging.info("Couldn't determine resolution, resampling disabled")
     
-    def append_styles(self, other_script, clean, resample, forced_resolution=None):
+    def resample(self, width, height, source_resolution=None, pool=None):
+        """Resample styles, margins and override tags of all events to a new resolution.
+        When a multiprocessing pool is provided, event text is processed in parallel chunks."""
+        script_info = self._find_section(SCRIPT_INFO_SECTION)
+        if script_info is None:
+            # the resampled resolution has to be written somewhere
+            script_info = ScriptInfoSection()
+            self._sections_list.insert(0, (SCRIPT_INFO_SECTION, script_info))
+        src_width, src_height = source_resolution or script_info.get_resolution()
+        if not src_width or not src_height:
+            raise PrassError("Couldn't determine resolution of the script")
+        scale_border_and_shadow = script_info.get_scaled_border_property()
+
+        styles_section = self._find_section(STYLES_SECTION)
+        for style in itervalues(styles_section.styles if styles_section else {}):
+            style.resample(src_width, src_height, width, height, scale_border_and_shadow)
+
+        scale_x = width / float(src_width)
+        scale_y = height / float(src_height)
+        resampler = OverrideTagsResampler(scale_x, scale_y, get_horizontal_stretch(src_width, src_height, width, height),
+                                          scale_border_and_shadow)
+        events = self._events
+        texts = [e.text for e in events]
+        if pool:
+            texts = pool.map(resampler, texts, chunksize=1000)
+        else:
+            texts = map(resampler, texts)
+        for event, text in zip(events, texts):
+            event.text = text
+            event.margin_left = int(round(event.margin_left * scale_x))
+            event.margin_right = int(round(event.margin_right * scale_x))
+            event.margin_vertical = int(round(event.margin_vertical * scale_y))
+
+        script_info.set_resolution(width, height)
+
+    def append_styles(self, other_script, clean, resample, forced_resolution=None, on_conflict='replace'):
         if clean:
             self._styles.clear()
 
@@ -408,13 +1215,25 @@ class AssScript(object):
         else:
             other_script_resampled = other_script
         for style in itervalues(other_script_resampled._styles):
+            existing = self._styles.get(style.name)
+            if existing is not None and existing.definition != style.definition:
+                if on_conflict == 'keep':
+                    continue
+                if on_conflict == 'error':
+                    raise PrassError(u"Style {0} is defined differently in two scripts".format(style.name))
             self._styles[style.name] = copy.deepcopy(style)
 
+    def build_events_index(self, include_comments=False):
+        events = self._events if include_comments else (e for e in self._events if not e.is_comment)
+        return IntervalIndex(events, lambda x: x.start, lambda x: x.end)
+
     def sort_events(self, key, descending):
+        if is_sorted(self._events, key, descending):
+            return
         self._events.sort(key=key, reverse=descending)
 
     def tpp(self, styles, lead_in, lead_out, max_overlap, max_gap, adjacent_bias,
-            keyframes_list, timecodes, kf_before_start, kf_after_start, kf_before_end, kf_after_end):
+            keyframes_list, timecodes, kf_before_start, kf_after_start, kf_before_end, kf_after_end, max_cps=None):
 
         def get_closest_kf(frame, keyframes):
             idx = bisect.bisect_left(keyframes, frame)
@@ -483,6 +1302,39 @@ class AssScript(object):
                         (closest_frame >= end_frame and closest_time - event.end <= kf_after_end):
                     event.end = closest_time
 
+        if max_cps:
+            self._enforce_cps(events_list, max_cps, keyframes_list, timecodes)
+
+    @staticmethod
+    def _enforce_cps(events, max_cps, keyframes_list, timecodes):
+        """Extend end times of events that are too fast to read, but never past the start of the next event
+        of the same style or past the next keyframe. Starts don't change here, so every cap is a binary search."""
+        starts_by_style = {}
+        for event in events:
+            starts_by_style.setdefault(event.style, []).append(event.start)
+        for starts in itervalues(starts_by_style):
+            starts.sort()
+
+        for event in events:
+            # rounded up to centiseconds because that's all ASS can store
+            required_end = int(math.ceil((event.start + count_characters(event.text) * 1000.0 / max_cps) / 10.0)) * 10
+            if required_end <= event.end:
+                continue
+            limit = required_end
+
+            starts = starts_by_style[event.style]
+            idx = bisect.bisect_left(starts, event.end)
+            if idx < len(starts):
+                limit = min(limit, starts[idx])
+
+            if keyframes_list and timecodes:
+                end_frame = timecodes.get_frame_number(event.end, timecodes.TIMESTAMP_END)
+                idx = bisect.bisect_right(keyframes_list, end_frame)
+                if idx < len(keyframes_list):
+                    limit = min(limit, timecodes.get_frame_time(keyframes_list[idx] - 1, timecodes.TIMESTAMP_END))
+
+            event.end = max(event.end, limit)
+
     def cleanup(self, drop_comments, drop_empty_lines, drop_unused_styles, drop_actors, drop_effects, drop_spacing, drop_sections):
         if drop_comments:
             self._events = [e for e in self._events if not e.is_comment]
@@ -516,10 +1368,139 @@ class AssScript(object):
                 event.text = re.sub(r"(\s|\\N|\\n)+", " ", event.text)
 
         if drop_sections:
-            self._sections_list = [x for x in self._sections_list if x[0] not in set(drop_sections)]
+            self.remove_sections(drop_sections)
+
+    def dedupe(self, merge_adjacent):
+        """Remove exact duplicates and, optionally, merge touching or overlapping events with identical text.
+        Returns a list of (kept, removed) event pairs."""
+        removed = []
+        removed_ids = set()
+        last_seen = {}
+        for event in sorted(self._events, key=lambda x: x.start):
+            if merge_adjacent:
+                key = (event.kind, event.layer, event.style, event.text)
+            else:
+                key = (event.kind, event.layer, event.style, event.text, event.start, event.end)
+            kept = last_seen.get(key)
+            if kept is not None and event.start <= kept.end:
+                kept.end = max(kept.end, event.end)
+                removed.append((kept, event))
+                removed_ids.add(id(event))
+            else:
+                last_seen[key] = event
+
+        if removed:
+            self._events = [e for e in self._events if id(e) not in removed_ids]
+        return removed
+
+    def check(self, rules, max_cps=None, video_end=None):
+        """Run lint rules over all non-comment events in a single pass.
+        Returns a sorted list of (event number, rule, event) tuples, event numbers start at 1."""
+        issues = []
+        styles = set(self._styles) if self._find_section(STYLES_SECTION) is not None else set()
+        numbered = [(idx, e) for idx, e in enumerate(self._events, 1) if not e.is_comment]
+
+        for idx, event in numbered:
+            if 'negative-duration' in rules and event.start > event.end:
+                issues.append((idx, 'negative-duration', event))
+            if 'missing-style' in rules and event.style not in styles:
+                issues.append((idx, 'missing-style', event))
+            if 'cps' in rules and event.end > event.start:
+                if count_characters(event.text) * 1000.0 / (event.end - event.start) > max_cps:
+                    issues.append((idx, 'cps', event))
+            if 'video-end' in rules and event.end > video_end:
+                issues.append((idx, 'video-end', event))
+
+        if 'overlap' in rules:
+            index = IntervalIndex(numbered, lambda x: x[1].start, lambda x: x[1].end)
+            # an event overlapping several earlier ones is still reported once
+            overlapping = dict(second for first, second in index.overlapping_pairs(lambda x: x[1].style))
+            issues.extend((idx, 'overlap', event) for idx, event in iteritems(overlapping))
+
+        issues.sort(key=lambda x: x[0])
+        return issues
+
+    def remove_sections(self, names):
+        """Remove all sections with these names, ignoring case like the parser does,
+        returning True if anything was removed"""
+        count = len(self._sections_list)
+        names = set(x.lower() for x in names)
+        self._sections_list = [x for x in self._sections_list if x[0].lower() not in names]
+        return len(self._sections_list) != count
+
+    def iter_attachments(self, section_name):
+        for name, section in self._sections_list:
+            if name.lower() == section_name.lower() and isinstance(section, AttachmentSection):
+                for attachment in section.iter_attachments():
+                    yield attachment
+
+    def split(self, times):
+        """Split script into len(times) + 1 scripts by event start time.
+        Events are sorted by start once and the boundaries are found by binary search.
+        Parts share all sections but events and styles with this script."""
+        events = sorted(self._events, key=lambda x: x.start)
+        starts = [e.start for e in events]
+        boundaries = [0] + [bisect.bisect_left(starts, t) for t in sorted(times)] + [len(events)]
+        parts = []
+        for lo, hi in zip(boundaries, boundaries[1:]):
+            sections = []
+            for name, section in self._sections_list:
+                if isinstance(section, StylesSection):
+                    section = copy.deepcopy(section)
+                elif section is self._find_section(EVENTS_SECTION):
+                    section = EventsSection()
+                    section.events = events[lo:hi]
+                sections.append((name, section))
+            parts.append(AssScript(sections))
+        return parts
+
+    def retime(self, source_timecodes, target_timecodes):
+        """Move events from one video timeline to another, keeping them on the same frames"""
+        events = self._events
+        try:
+            starts = self._retime_times([e.start for e in events], Timecodes.TIMESTAMP_START,
+                                        source_timecodes, target_timecodes)
+            ends = self._retime_times([e.end for e in events], Timecodes.TIMESTAMP_END,
+                                      source_timecodes, target_timecodes)
+        except ValueError as e:
+            raise PrassError(u"Can't retime events outside of the timecodes file: {0}".format(e))
+        for event, start, end in zip(events, starts, ends):
+            event.start = max(0, start)
+            event.end = max(event.start, end)
+
+    @staticmethod
+    def _retime_times(times, kind, source_timecodes, target_timecodes):
+        # a start time falls into (frame - 1, frame], an end time into (frame, frame + 1]
+        frames = source_timecodes.get_frame_numbers(times, kind)
+        neighbours = [x + (-1 if kind == Timecodes.TIMESTAMP_START else 1) for x in frames]
+        source_frames, source_neighbours = source_timecodes.get_frame_times(frames), \
+            source_timecodes.get_frame_times(neighbours)
+        target_frames, target_neighbours = target_timecodes.get_frame_times(frames), \
+            target_timecodes.get_frame_times(neighbours)
+        if kind == Timecodes.TIMESTAMP_START:
+            new_times = Timecodes.frame_boundaries(target_neighbours, target_frames)
+        else:
+            new_times = Timecodes.frame_boundaries(target_frames, target_neighbours)
+        # times stay as they are where both timelines agree, otherwise go to the middle of the interval
+        return [time if source_frame == target_frame and source_neighbour == target_neighbour else new_time
+                for time, new_time, source_frame, source_neighbour, target_frame, target_neighbour
+                in zip(times, new_times, source_frames, source_neighbours, target_frames, target_neighbours)]
+
+    def find_events(self, matcher):
+        return [e for e in self._events if matcher.search(e)]
+
+    def map_events(self, transform):
+        for event in self._events:
+            transform(event)
+
+    def replace_text(self, matcher, replacement):
+        return sum(matcher.sub(replacement, e) for e in self._events)
 
-    def shift(self, shift, shift_start, shift_end, multiplier):
+    def shift(self, shift, shift_start, shift_end, multiplier, scale_tags=False):
+        scaler = TimingTagsScaler(multiplier) if scale_tags and multiplier != 1 else None
         for event in self._events:
+            if scaler:
+                event.text = scaler(event.text)
             if shift_start:
                 event.start = max(event.start + shift, 0)
             if shift_end:
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import codecs
+import os
+import unittest
+from io import BytesIO
+
+import aio
+
+
+def get_script_path(name):
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(script_dir, name)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncReader(object):
+    def __init__(self, data, chunk_size):
+        self._stream = BytesIO(data)
+        self._chunk_size = chunk_size
+
+    async def read(self, n=-1):
+        return self._stream.read(min(n, self._chunk_size))
+
+
+class AsyncWriter(object):
+    def __init__(self):
+        self.buffer = BytesIO()
+
+    async def write(self, data):
+        self.buffer.write(data)
+
+
+class TestAsyncApi(unittest.TestCase):
+    def test_roundtrip(self):
+        with open(get_script_path("test_script.ass"), "rb") as script:
+            data = script.read()
+        # small chunks split lines and multibyte characters between reads
+        script = run(aio.read_script(AsyncReader(data, 7), lines_per_yield=3))
+        writer = AsyncWriter()
+        run(aio.write_script(script, writer, lines_per_yield=5))
+        expected = codecs.decode(data, "utf-8-sig").replace(u"\r\n", u"\n")
+        self.assertEqual(expected, writer.buffer.getvalue().decode("utf-8"))
+
+    def test_run_transform(self):
+        with open(get_script_path("test_script.ass"), "rb") as script:
+            script = run(aio.read_script(AsyncReader(script.read(), 4096)))
+        script = run(aio.run_transform(script, "shift", 1000, True, True, 1))
+        self.assertEqual(1000 + 910, script._events[0].start)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import corpus
+from common import PrassError
+
+
+def get_script_path(name):
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(script_dir, name)
+
+
+class TestCorpusIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.script_path = os.path.join(self.directory, "script.ass")
+        shutil.copy(get_script_path("test_script.ass"), self.script_path)
+        self.index = corpus.CorpusIndex(os.path.join(self.directory, "index.db"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_incremental_update(self):
+        self.assertEqual([self.script_path], self.index.update([self.script_path]))
+        self.assertEqual([], self.index.update([self.script_path]))
+
+        with open(self.script_path, "rb") as script:
+            text = script.read()
+        with open(self.script_path, "wb") as script:
+            script.write(text.replace(b"Don't be.", b"Don't be, kimono."))
+        self.assertEqual([self.script_path], self.index.update([self.script_path]))
+        self.assertEqual(2, len(list(self.index.search(u"kimono"))))
+
+    def test_search(self):
+        cleanup_path = os.path.join(self.directory, "cleanup.ass")
+        shutil.copy(get_script_path("cleanup_script.ass"), cleanup_path)
+        self.index.update([self.script_path, cleanup_path])
+        results = list(self.index.search(u"kimono", style=u"Main"))
+        self.assertEqual([cleanup_path, self.script_path], [path for path, _ in results])
+        self.assertEqual(u"Dialogue: 0,0:00:13.02,0:00:15.91,Main,Shin,0,0,0,,Meanwhile, all I wear now \\Nis this "
+                         u"{\\b1\\rInternal}twin-striped kimono.", u"%s" % results[1][1])
+        self.assertEqual([], list(self.index.search(u"kimono", style=u"Default")))
+
+    def test_find_style(self):
+        self.index.update([self.script_path])
+        rows = list(self.index.find_style(u"Main"))
+        self.assertEqual(1, len(rows))
+        self.assertEqual((self.script_path, 848, 480), (rows[0][0], rows[0][2], rows[0][3]))
+
+    def test_missing_sections(self):
+        info_path = os.path.join(self.directory, "info.ass")
+        with open(info_path, "w") as script:
+            script.write("[Script Info]\nTitle: nothing else\n")
+        self.assertEqual([info_path], self.index.update([info_path]))
+        self.assertEqual([], list(self.index.find_style(u"Main")))
+
+    def test_invalid_script(self):
+        ssa_path = os.path.join(self.directory, "old.ssa")
+        with open(ssa_path, "w") as script:
+            script.write("[Events]\nDialogue: Marked=0,0:00:01.00,0:00:02.00,Default,,0000,0000,0000,,Hello\n")
+        with self.assertRaises(PrassError) as context:
+            self.index.update([ssa_path])
+        self.assertIn(ssa_path, context.exception.message)
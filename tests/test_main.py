@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 import unittest
 
+from click.testing import CliRunner
+
 import prass
 import common
 
@@ -53,3 +58,115 @@ class TestResolutionParsing(unittest.TestCase):
         self.assertRaises(common.PrassError, lambda: prass.parse_resolution_string("1920.1080"))
         self.assertRaises(common.PrassError, lambda: prass.parse_resolution_string("1963p"))
         self.assertRaises(common.PrassError, lambda: prass.parse_resolution_string("not a number"))
+
+
+class TestIncrementalOutput(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_script.ass")
+        self.output_path = os.path.join(self.directory, "output.ass")
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_sort(self, *args):
+        result = CliRunner().invoke(prass.cli, list(args) + ["sort", self.input_path, "-o", self.output_path])
+        self.assertEqual(0, result.exit_code, result.output)
+
+    def test_if_changed(self):
+        self.run_sort("--if-changed")
+        os.utime(self.output_path, (0, 0))
+        self.run_sort("--if-changed")
+        self.assertEqual(0, os.path.getmtime(self.output_path))
+        self.run_sort()
+        self.assertNotEqual(0, os.path.getmtime(self.output_path))
+
+    def test_manifest(self):
+        self.run_sort("--manifest", self.manifest_path)
+        with open(self.output_path, "w") as output:
+            output.write("modified")
+        self.run_sort("--manifest", self.manifest_path)
+        with open(self.output_path) as output:
+            self.assertEqual("modified", output.read())
+
+    def test_manifest_skips_parsing_side_files(self):
+        keyframes_path = os.path.join(self.directory, "keyframes.txt")
+        with open(keyframes_path, "w") as keyframes:
+            keyframes.write("# XviD 2pass stat file\n\n\ni\np\ni\n")
+        args = ["--manifest", self.manifest_path, "tpp", self.input_path, "--keyframes", keyframes_path,
+                "--fps", "25", "--kf-before-start", "100", "-o", self.output_path]
+        self.assertEqual(0, CliRunner().invoke(prass.cli, args).exit_code)
+
+        def fail(*args):
+            raise AssertionError("side files should not be parsed")
+        parse_keyframes, prass.parse_keyframes = prass.parse_keyframes, fail
+        try:
+            result = CliRunner().invoke(prass.cli, args)
+        finally:
+            prass.parse_keyframes = parse_keyframes
+        self.assertEqual(0, result.exit_code, result.output)
+
+
+class TestTpp(unittest.TestCase):
+    def test_max_cps_with_keyframes_requires_timecodes(self):
+        script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_script.ass")
+        result = CliRunner().invoke(prass.cli, ["tpp", script_path, "--max-cps", "20", "--keyframes", script_path])
+        self.assertEqual(1, result.exit_code)
+        self.assertIn("fps or timecodes", result.output)
+
+
+class TestMap(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for idx in range(2):
+            path = os.path.join(self.directory, "{0}.ass".format(idx))
+            shutil.copy(os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_script.ass"), path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_in_place(self):
+        result = CliRunner().invoke(prass.cli, ["map", "-e", "if actor == 'Tae': layer = 5",
+                                                "--in-place", "--jobs", "2"] + self.paths)
+        self.assertEqual(0, result.exit_code, result.output)
+        for path in self.paths:
+            with open(path) as script:
+                self.assertIn("Dialogue: 5,0:00:00.91,0:00:03.44,Main,Tae", script.read())
+
+    def test_requires_in_place_for_many_files(self):
+        result = CliRunner().invoke(prass.cli, ["map", "-e", "layer = 1"] + self.paths)
+        self.assertNotEqual(0, result.exit_code)
+
+
+class TestCheck(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.timecodes_path = os.path.join(self.directory, "tc.txt")
+        with open(self.timecodes_path, "w") as timecodes:
+            timecodes.write("# timecode format v2\n0\n1000\n2000\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_check(self, end, *args):
+        result = CliRunner().invoke(prass.cli, ["check", "-", "--rule", "video-end", "--timecodes", self.timecodes_path]
+                                    + list(args),
+                                    input=u"[Events]\nDialogue: 0,0:00:01.00,{0},A,,0,0,0,,line\n".format(end))
+        return result.exit_code
+
+    def test_video_end_includes_last_frame(self):
+        self.assertEqual(0, self.run_check("0:00:02.50"))
+        self.assertEqual(3, self.run_check("0:00:03.50"))
+
+    def test_v1_timecodes_need_video_frames(self):
+        with open(self.timecodes_path, "w") as timecodes:
+            timecodes.write("# timecode format v1\nAssume 25\n0,1,50\n")
+        result = CliRunner().invoke(prass.cli, ["check", "-", "--timecodes", self.timecodes_path],
+                                    input=u"[Events]\nDialogue: 0,0:00:01.00,0:00:02.00,A,,0,0,0,,line\n")
+        self.assertEqual(1, result.exit_code)
+        self.assertIn("--video-frames", result.output)
+        self.assertEqual(0, self.run_check("0:00:02.00", "--video-frames", "100"))
+        self.assertEqual(3, self.run_check("0:00:05.00", "--video-frames", "100"))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from io import BytesIO
+
+import stats
+import subs
+
+
+def get_script_path(name):
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(script_dir, name)
+
+
+class TestScriptStats(unittest.TestCase):
+    def test_single_file(self):
+        path = get_script_path("test_script.ass")
+        summary = stats.ScriptStats.from_file(path).to_dict()
+        script = subs.AssScript.from_ass_file(path)
+        dialogue = [e for e in script._events if not e.is_comment]
+        self.assertEqual(len(dialogue), summary["events"])
+        self.assertEqual(1, summary["comments"])
+        self.assertEqual(sum(e.end - e.start for e in dialogue), summary["total_duration"])
+        self.assertEqual({"Tae": 4, "Shin": 6}, summary["actors"])
+        self.assertEqual({"848x480": 1}, summary["resolutions"])
+        attachments = {}
+        for section in ("[Fonts]", "[Graphics]"):
+            for name, data in script.iter_attachments(section):
+                attachments[name] = attachments.get(name, 0) + len(data)
+        self.assertEqual(attachments, summary["attachments"])
+
+    def test_merge(self):
+        total = stats.ScriptStats()
+        for _ in range(2):
+            total.merge(stats.ScriptStats.from_file(get_script_path("test_script.ass")))
+        summary = total.to_dict()
+        self.assertEqual(2, summary["files"])
+        self.assertEqual(20, summary["events"])
+        self.assertEqual({"848x480": 2}, summary["resolutions"])
+
+    def test_binary_pipe_format(self):
+        path = get_script_path("test_script.ass")
+        binary = BytesIO()
+        subs.AssScript.from_ass_file(path).to_binary_stream(binary)
+        binary.seek(0)
+        with open(path, "rb") as script:
+            text = BytesIO(script.read())
+        self.assertEqual(stats.ScriptStats.from_file(path).to_dict(), stats.ScriptStats.from_byte_stream(binary).to_dict())
+        self.assertEqual(stats.ScriptStats.from_file(path).to_dict(), stats.ScriptStats.from_byte_stream(text).to_dict())
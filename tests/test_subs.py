@@ -2,12 +2,18 @@
 import unittest
 import os
 import codecs
+import pickle
+import re
+from operator import attrgetter
+from io import BytesIO
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
 import subs
+import tools
+from common import PrassError
 
 
 def get_script_path(name):
@@ -48,6 +54,42 @@ class TestSubs(unittest.TestCase):
         self.assertEqual(subs.srt_line_to_ass('<font color="#FF0000">text</font>'), 
                         '{\\c&H0000FF&}text{\\c&HFFFFFF&}')
 
+    def test_event_parsing(self):
+        strings = {}
+        first = subs.AssEvent.from_text(u"Dialogue: 0,0:00:00.91,0:00:03.44,Main,Tae,0010,0,20,,Text", strings)
+        second = subs.AssEvent.from_text(u"Dialogue: 1,0:00:03.44,0:00:04.46,Main,Tae,0,0,0,,Other", strings)
+        self.assertEqual((10, 0, 20), (first.margin_left, first.margin_right, first.margin_vertical))
+        self.assertIs(first.style, second.style)
+        self.assertIs(first.kind, second.kind)
+        self.assertEqual(u"Dialogue: 0,0:00:00.91,0:00:03.44,Main,Tae,10,0,20,,Text", u"%s" % first)
+
+    def test_event_parsing_empty_margins(self):
+        event = subs.AssEvent.from_text(u"Dialogue: 0,0:00:01.00,0:00:02.00,A,,, ,,,line")
+        self.assertEqual((0, 0, 0), (event.margin_left, event.margin_right, event.margin_vertical))
+        self.assertRaises(PrassError, lambda: subs.AssEvent.from_text(u"Dialogue: 0,0:00:01.00,0:00:02.00,A,,x,,,,a"))
+
+    def test_ass_line_to_html(self):
+        self.assertEqual(u'<u>underlined</u>\n0<b>1<i>2<s> many </i>3</s>4</b>5',
+                         subs.ass_line_to_html(subs.srt_line_to_ass(u'<u>underlined</u>\n 0<b>1<i>2<s> many </i>3</s>4</b>5')))
+        self.assertEqual(u'<i>a &amp; &lt;b&gt;\nc</i>',
+                         subs.ass_line_to_html(u'{\\an8\\i1}a & <b>\\N\\N c', tags=(u'i', u'b', u'u'), escape=True))
+        self.assertEqual(u'twin kimono', subs.ass_line_to_html(u'{\\b1\\rInternal}twin {\\p1\\pos(1,1)}m 0 0 l 1 1{\\p0}kimono'))
+
+    def test_srt_export(self):
+        section = subs.EventsSection()
+        section.events = [subs.AssEvent(3723004, 3724000, u"second"), subs.AssEvent(0, 1500, u"{\\i1}first\\Nline"),
+                          subs.AssEvent(100, 200, u"comment", kind=u"Comment"), subs.AssEvent(200, 300, u"{\\fad(1,1)}")]
+        ass_script = subs.AssScript([(subs.EVENTS_SECTION, section)])
+        buffer = StringIO()
+        ass_script.to_srt_stream(buffer)
+        self.assertEqual(u"1\n00:00:00,000 --> 00:00:01,500\n<i>first\nline</i>\n\n"
+                         u"2\n01:02:03,004 --> 01:02:04,000\nsecond\n\n", buffer.getvalue())
+
+        buffer = StringIO()
+        ass_script.to_vtt_stream(buffer)
+        self.assertEqual(u"WEBVTT\n\n00:00:00.000 --> 00:00:01.500\n<i>first\nline</i>\n\n"
+                         u"01:02:03.004 --> 01:02:04.000\nsecond\n\n", buffer.getvalue())
+
     def test_cleanup(self):
         # this test also ensures that we leave two [Graphics] sections in their proper positions
         ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
@@ -56,10 +98,217 @@ class TestSubs(unittest.TestCase):
 
         self.assertEqual(load_script("cleanup_script.ass"), script_to_string(ass_script))
 
+    def test_parallel_parsing(self):
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"), jobs=2)
+        self.assertEqual(load_script("test_script.ass"), script_to_string(ass_script))
+
+    def test_binary_roundtrip(self):
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        buffer = BytesIO()
+        ass_script.to_binary_stream(buffer)
+        buffer.seek(0)
+        self.assertEqual(load_script("test_script.ass"), script_to_string(subs.AssScript.from_stream(buffer)))
+
+    def test_binary_rejects_other_versions_and_garbage(self):
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        buffer = BytesIO()
+        ass_script.to_binary_stream(buffer)
+        data = buffer.getvalue()
+        header_size = len(subs.BINARY_MAGIC) + 1
+        old_version = subs.BINARY_MAGIC + b"\x01" + data[header_size:]
+        truncated = data[:len(data) // 2]
+        malformed = data[:header_size] + b'[["[Events]","events",[[1]]]]'
+        for broken in (old_version, truncated, malformed):
+            self.assertRaises(PrassError, lambda: subs.AssScript.from_stream(BytesIO(broken)))
+
+    def test_stream_detects_ass(self):
+        with open(get_script_path("test_script.ass"), "rb") as input_file:
+            ass_script = subs.AssScript.from_stream(input_file)
+        self.assertEqual(load_script("test_script.ass"), script_to_string(ass_script))
+
+    def test_dedupe(self):
+        events = [subs.AssEvent(0, 1000, u"a"), subs.AssEvent(0, 1000, u"a"), subs.AssEvent(1000, 2000, u"a"),
+                  subs.AssEvent(500, 1500, u"b"), subs.AssEvent(3000, 4000, u"a"), subs.AssEvent(0, 1000, u"a", layer=1)]
+        section = subs.EventsSection()
+        section.events = list(events)
+        ass_script = subs.AssScript([(subs.EVENTS_SECTION, section)])
+
+        removed = ass_script.dedupe(merge_adjacent=True)
+        self.assertEqual([(events[0], events[1]), (events[0], events[2])], removed)
+        self.assertEqual([events[0], events[3], events[4], events[5]], ass_script._events)
+        self.assertEqual(2000, events[0].end)
+
+    def test_dedupe_exact(self):
+        events = [subs.AssEvent(0, 1000, u"a"), subs.AssEvent(1000, 2000, u"a"), subs.AssEvent(0, 1000, u"a")]
+        section = subs.EventsSection()
+        section.events = list(events)
+        ass_script = subs.AssScript([(subs.EVENTS_SECTION, section)])
+
+        self.assertEqual([(events[0], events[2])], ass_script.dedupe(merge_adjacent=False))
+        self.assertEqual([events[0], events[1]], ass_script._events)
+
+    def test_diff_events(self):
+        old = [subs.AssEvent(0, 1000, u"same"), subs.AssEvent(1000, 2000, u"moved"),
+               subs.AssEvent(2000, 3000, u"{\\i1}tagged"), subs.AssEvent(3000, 4000, u"typo"),
+               subs.AssEvent(5000, 6000, u"gone")]
+        new = [subs.AssEvent(9000, 9500, u"added"), subs.AssEvent(3000, 4000, u"fixed"),
+               subs.AssEvent(2000, 3000, u"tagged"), subs.AssEvent(1500, 2000, u"moved"),
+               subs.AssEvent(0, 1000, u"same")]
+        changes = subs.diff_events(old, new, time_tolerance=500)
+        self.assertEqual([('retimed', old[1], new[3]), ('retexted', old[2], new[2]), ('retexted', old[3], new[1]),
+                          ('removed', old[4], None), ('added', None, new[0])], changes)
+
+    def test_check(self):
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        ass_script._events.extend([subs.AssEvent(5000, 4000, u"broken", style=u"Main"),
+                                   subs.AssEvent(20000, 21000, u"unknown", style=u"Signs"),
+                                   subs.AssEvent(20000, 30000, u"overlap", style=u"Main")])
+        issues = ass_script.check(['negative-duration', 'missing-style', 'overlap', 'cps', 'video-end'],
+                                  max_cps=19.8, video_end=25000)
+        self.assertEqual([(10, 'cps'), (12, 'negative-duration'), (13, 'missing-style'), (14, 'video-end'),
+                          (14, 'overlap')], [(idx, rule) for idx, rule, _ in issues])
+
+    def test_check_overlap_reported_once(self):
+        ass_script = subs.AssScript.from_ass_stream([u"[Events]"] + [
+            u"Dialogue: 0,0:00:0{0}.00,0:00:09.00,A,,0,0,0,,line".format(x) for x in range(3)])
+        self.assertEqual([2, 3], [idx for idx, rule, _ in ass_script.check(['overlap'])])
+
+    def test_window_events_section(self):
+        for assume_sorted in (False, True):
+            with codecs.open(get_script_path("test_script.ass"), encoding="utf-8-sig") as input_file:
+                ass_script = subs.AssScript.from_ass_stream(
+                    input_file, lambda: subs.WindowEventsSection(9000, 13000, assume_sorted))
+            self.assertEqual([7600, 9610, 11650, 11650], [e.start for e in ass_script._events])
+
+    def test_window_events_section_with_added_events(self):
+        path = get_script_path("test_script.ass")
+        buffer = BytesIO()
+        subs.AssScript.from_ass_file(path).to_binary_stream(buffer)
+        for assume_sorted in (False, True):
+            window = lambda: subs.WindowEventsSection(9000, 13000, assume_sorted)
+            buffer.seek(len(subs.BINARY_MAGIC))
+            for ass_script in (subs.AssScript.from_ass_file(path, window, jobs=2),
+                               subs.AssScript.from_binary_stream(buffer, window)):
+                self.assertEqual([7600, 9610, 11650, 11650], [e.start for e in ass_script._events])
+
+    def test_sorted_file_window_matches_stream(self):
+        path = get_script_path("test_script.ass")
+        for start, end in ((0, 1000), (5000, 5001), (9000, 13000), (50000, 60000), (0, 10 ** 9)):
+            with codecs.open(path, encoding="utf-8-sig") as input_file:
+                expected = subs.AssScript.from_ass_stream(input_file, lambda: subs.WindowEventsSection(start, end))
+            self.assertEqual(script_to_string(expected),
+                             script_to_string(subs.AssScript.from_sorted_ass_file_window(path, start, end)))
+
+    def test_resample_without_script_info(self):
+        ass_script = subs.AssScript.from_ass_stream([u"[Events]", u"Dialogue: 0,0:00:01.00,0:00:02.00,A,,10,0,0,,"
+                                                                  u"{\\bord2}line"])
+        self.assertRaises(PrassError, lambda: ass_script.resample(1280, 720))
+        ass_script.resample(1280, 720, source_resolution=(640, 360))
+        self.assertEqual((1280, 720), ass_script._find_section(subs.SCRIPT_INFO_SECTION).get_resolution())
+        self.assertEqual([(20, u"{\\bord4}line")], [(e.margin_left, e.text) for e in ass_script._events])
+
+    def test_split(self):
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        parts = ass_script.split([10000, 5000])
+        self.assertEqual([3, 3, 5], [len(x._events) for x in parts])
+        self.assertEqual([7600, 7600, 9610], [e.start for e in parts[1]._events])
+        parts[0]._styles.clear()
+        self.assertEqual(5, len(parts[1]._styles))
+
+    def test_retime(self):
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        source = tools.Timecodes.cfr(1.0)
+        frames = [(source.get_frame_number(e.start, source.TIMESTAMP_START),
+                   source.get_frame_number(e.end, source.TIMESTAMP_END)) for e in ass_script._events]
+        ass_script.retime(source, tools.Timecodes.cfr(2.0))
+        ass_script.retime(tools.Timecodes.cfr(2.0), source)
+        self.assertEqual(frames, [(source.get_frame_number(e.start, source.TIMESTAMP_START),
+                                   source.get_frame_number(e.end, source.TIMESTAMP_END)) for e in ass_script._events])
+
+    def test_retime_v2(self):
+        fps = 24000 / 1001.0
+        v2 = tools.Timecodes.parse(u"# timecode format v2\n" + u"\n".join(
+            u"{0:.3f}".format(x * 1000 / fps) for x in range(480)))
+        cfr = tools.Timecodes.cfr(fps)
+        ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        ass_script._events[0].start = 0
+        expected = script_to_string(ass_script)
+        ass_script.retime(v2, v2)
+        self.assertEqual(expected, script_to_string(ass_script))
+
+        frames = [(cfr.get_frame_number(e.start, cfr.TIMESTAMP_START), cfr.get_frame_number(e.end, cfr.TIMESTAMP_END))
+                  for e in ass_script._events]
+        ass_script.retime(cfr, v2)
+        self.assertEqual(frames, [(v2.get_frame_number(e.start, v2.TIMESTAMP_START),
+                                   v2.get_frame_number(e.end, v2.TIMESTAMP_END)) for e in ass_script._events])
+        self.assertEqual(0, ass_script._events[0].start)
+        self.assertLess(0, ass_script._events[0].end)
+
+    def test_event_transform(self):
+        transform = pickle.loads(pickle.dumps(subs.EventTransform(
+            u"if style == 'Main':\n    layer = 3\nend = max(end, start + 5000)\ntext = strip_tags(text)")))
+        event = subs.AssEvent(1000, 2000, u"{\\i1}text", style=u"Main")
+        transform(event)
+        self.assertEqual((3, 6000, u"text"), (event.layer, event.end, event.text))
+
+    def test_tpp_max_cps(self):
+        ass_script = subs.AssScript.from_ass_stream([
+            u"[Events]",
+            u"Dialogue: 0,0:00:00.00,0:00:01.00,A,,0,0,0,,aaaaaaaaaaaaaaaaaaaa",
+            u"Dialogue: 0,0:00:01.50,0:00:02.00,A,,0,0,0,,{\\i1}bbbbbbbbbb",
+            u"Dialogue: 0,0:00:01.00,0:00:01.20,B,,0,0,0,,cc",
+        ])
+        ass_script.tpp(None, 0, 0, 0, 0, 50, [0, 23], tools.Timecodes.cfr(10), 0, 0, 0, 0, max_cps=10)
+        # capped by the next line of the same style, by the keyframe at 2300 and already slow enough
+        self.assertEqual([1500, 2250, 1200], [e.end for e in ass_script._events])
+
+    def test_shift_scale_tags(self):
+        ass_script = subs.AssScript.from_ass_stream([
+            u"[Events]",
+            u"Dialogue: 0,0:00:01.00,0:00:02.00,A,,0,0,0,,{\\k10}a{\\kf15}b{\\t(0,500,\\fs20)\\move(1,2,3,4,100,300)}c",
+            u"Dialogue: 0,0:00:02.00,0:00:03.00,A,,0,0,0,,{\\fad(100,200)\\fade(255,0,255,0,10,20,30)}\\k10 {\\an8}",
+        ])
+        ass_script.shift(0, True, True, 1.5, scale_tags=True)
+        self.assertEqual([u"{\\k15}a{\\kf23}b{\\t(0,750,\\fs20)\\move(1,2,3,4,150,450)}c",
+                          u"{\\fad(150,300)\\fade(255,0,255,0,15,30,45)}\\k10 {\\an8}"],
+                         [e.text for e in ass_script._events])
+
+    def test_remove_sections_ignores_case(self):
+        ass_script = subs.AssScript.from_ass_stream([u"[Script Info]", u"Title: x", u"[fonts]", u"fontname: a.ttf"])
+        self.assertTrue(ass_script.remove_sections([u"[Fonts]"]))
+        self.assertEqual([u"[Script Info]"], [name for name, _ in ass_script._sections_list])
+
     def test_noop(self):
         ass_script = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
         self.assertEqual(load_script("test_script.ass"), script_to_string(ass_script))
 
+    def test_external_sort(self):
+        key = attrgetter("style", "end")
+        expected = subs.AssScript.from_ass_file(get_script_path("test_script.ass"))
+        expected.sort_events(key, descending=True)
+
+        with codecs.open(get_script_path("test_script.ass"), encoding="utf-8-sig") as input_file:
+            ass_script = subs.AssScript.from_ass_stream(
+                input_file, events_section_factory=lambda: subs.ExternalSortEventsSection(key, True, 3))
+        self.assertEqual(script_to_string(expected), script_to_string(ass_script))
+
+    def test_merge_files(self):
+        path = get_script_path("test_script.ass")
+        merged = subs.AssScript.merge_files([path, get_script_path("cleanup_script.ass")], 'keep', resample=False)
+        events = list(merged._events)
+        self.assertEqual(20, len(events))
+        self.assertEqual(sorted(e.start for e in events), [e.start for e in events])
+        self.assertEqual(["Default", "Main", "Internal", "Flashback", "Ep Title"], list(merged._styles.keys()))
+
+    def test_merge_files_conflict(self):
+        path = get_script_path("test_script.ass")
+        script = subs.AssScript.from_ass_file(path)
+        script._styles["Main"].definition = u"Arial,20"
+        other = subs.AssScript.from_ass_file(path)
+        self.assertRaises(PrassError, lambda: script.append_styles(other, False, False, on_conflict='error'))
+        script.append_styles(other, False, False, on_conflict='keep')
+        self.assertEqual(u"Arial,20", script._styles["Main"].definition)
+
 
 class TestStyles(unittest.TestCase):
     def test_resample(self):
@@ -68,6 +317,66 @@ class TestStyles(unittest.TestCase):
         self.assertEqual(source.definition, u"Arial,81,&H00FFFFFF,&H000000FF,&H00020713,&H00000000,-1,0,0,0,100,100,0,0,1,3.825,0,2,0,0,63,1")
 
 
+class TestOverrideTagsResampler(unittest.TestCase):
+    def test_tags(self):
+        resampler = subs.OverrideTagsResampler(2.0, 1.5, 1.0, True)
+        self.assertEqual(u"{\\pos(20,30)\\fs30\\fscy100\\bord3\\move(2,3,6,6,100,200)\\clip(0,0,20,15)}text",
+                         resampler(u"{\\pos(10,20)\\fs20\\fscy100\\bord2\\move(1,2,3,4,100,200)\\clip(0,0,10,10)}text"))
+        self.assertEqual(u"{\\t(0,10,\\fs15)\\iclip(m 2 1.5 l 4 3)}", resampler(u"{\\t(0,10,\\fs10)\\iclip(m 1 1 l 2 2)}"))
+
+    def test_drawing(self):
+        resampler = subs.OverrideTagsResampler(2.0, 1.5, 1.0, True)
+        self.assertEqual(u"{\\p1}m 0 0 l 20 15.75{\\p0}10 10", resampler(u"{\\p1}m 0 0 l 10 10.5{\\p0}10 10"))
+
+    def test_no_tags(self):
+        resampler = subs.OverrideTagsResampler(2.0, 1.5, 1.0, False)
+        text = u"plain 10 text"
+        self.assertIs(text, resampler(text))
+        self.assertEqual(u"{\\bord2\\fsp4}", resampler(u"{\\bord2\\fsp2}"))
+
+
+class TestEventMatcher(unittest.TestCase):
+    def test_filters(self):
+        matcher = subs.EventMatcher(u"text", styles=[u"default"], layers=[0])
+        self.assertTrue(matcher.search(subs.AssEvent(0, 1, u"some text")))
+        self.assertFalse(matcher.search(subs.AssEvent(0, 1, u"some text", style=u"Signs")))
+        self.assertFalse(matcher.search(subs.AssEvent(0, 1, u"some text", layer=1)))
+
+    def test_ignore_tags(self):
+        event = subs.AssEvent(0, 1, u"{\\fnArial}Arial and {\\i1}Arial")
+        self.assertEqual(2, subs.EventMatcher(u"Arial", ignore_tags=True).sub(u"Verdana", event))
+        self.assertEqual(u"{\\fnArial}Verdana and {\\i1}Verdana", event.text)
+        self.assertFalse(subs.EventMatcher(u"fnArial", ignore_tags=True).search(event))
+        self.assertTrue(subs.EventMatcher(u"fnArial").search(event))
+
+    def test_check_replacement(self):
+        matcher = subs.EventMatcher(u"(Shin)-(?P<suffix>chan)")
+        matcher.check_replacement(u"\\2 \\g<suffix> \\1")
+        self.assertRaises(re.error, lambda: matcher.check_replacement(u"\\9"))
+
+
+class TestAttachmentSection(unittest.TestCase):
+    @staticmethod
+    def encode(data):
+        # straightforward port of the aegisub encoder
+        data = bytearray(data)
+        result = []
+        for pos in range(0, len(data), 3):
+            chunk = data[pos:pos + 3]
+            src = list(chunk) + [0] * (3 - len(chunk))
+            dst = [src[0] >> 2, ((src[0] & 0x3) << 4) | ((src[1] & 0xF0) >> 4),
+                   ((src[1] & 0xF) << 2) | ((src[2] & 0xC0) >> 6), src[2] & 0x3F]
+            result.extend(chr(x + 33) for x in dst[:len(chunk) + 1])
+        text = u"".join(result)
+        return [text[pos:pos + 80] for pos in range(0, len(text), 80)]
+
+    def test_decoding(self):
+        first, second = bytes(bytearray(range(256)) * 3), b"font"
+        section = subs.AttachmentSection()
+        section.lines = [u"fontname: first.ttf"] + self.encode(first) + [u"fontname: second.ttf"] + self.encode(second)
+        self.assertEqual([(u"first.ttf", first), (u"second.ttf", second)], list(section.iter_attachments()))
+
+
 class TestScriptInfoSection(unittest.TestCase):
     def test_comments(self):
         section = subs.ScriptInfoSection()
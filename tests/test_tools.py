@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 import unittest
 
 import tools
@@ -46,3 +49,108 @@ class TestTimecodes(unittest.TestCase):
         self.assertEqual(500, timecodes.get_frame_time(0, timecodes.TIMESTAMP_END))
         self.assertEqual(1500, timecodes.get_frame_time(1, timecodes.TIMESTAMP_END))
         self.assertEqual(2500, timecodes.get_frame_time(2, timecodes.TIMESTAMP_END))
+
+    def test_get_frame_numbers_matches_single(self):
+        values = [500, 0, 79, 80, 81, 150, 199, 200, 230, -10]
+        numbers = list(range(-3, 9))
+        for timecodes in (tools.Timecodes([0, 40, 80, 140, 200], default_fps=25),
+                          tools.Timecodes([0, 40, 80, 140, 200], default_fps=None), tools.Timecodes.cfr(23.976)):
+            for kind in (None, timecodes.TIMESTAMP_START, timecodes.TIMESTAMP_END):
+                self.assertEqual([timecodes.get_frame_number(x, kind) for x in values],
+                                 timecodes.get_frame_numbers(values, kind))
+                self.assertEqual([timecodes.get_frame_time(x, kind) for x in numbers],
+                                 timecodes.get_frame_times(numbers, kind))
+
+    def test_v2_matches_cfr(self):
+        fps = 24000 / 1001.0
+        cfr = tools.Timecodes.cfr(fps)
+        v2 = tools.Timecodes.parse(u"# timecode format v2\n" + u"\n".join(
+            u"{0:.3f}".format(x * 1000 / fps) for x in range(240)))
+        values = list(range(-100, 12000, 7))
+        for kind in (None, cfr.TIMESTAMP_START, cfr.TIMESTAMP_END):
+            self.assertEqual([cfr.get_frame_number(x, kind) for x in values], v2.get_frame_numbers(values, kind))
+        self.assertEqual(23, v2.get_frame_number(1000))
+        self.assertEqual(-42, v2.get_frame_time(-1))
+        self.assertEqual(-21, v2.get_frame_time(0, v2.TIMESTAMP_START))
+
+
+class TestTimecodesParsing(unittest.TestCase):
+    def test_v2(self):
+        timecodes = tools.Timecodes.parse("# timecode format v2\n0\n41.708\n83.417\n")
+        self.assertEqual([0, 41.708, 83.417], timecodes.times)
+        self.assertEqual(1, timecodes.get_frame_number(41.708))
+
+
+class TestArrayCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file_object:
+            file_object.write(text)
+        return path
+
+    def test_timecodes(self):
+        path = self.write("tc.txt", "# timecode format v1\nAssume 25\n0,1,50\n")
+        expected = tools.Timecodes.from_file(path)
+        for _ in range(2):
+            timecodes = tools.Timecodes.from_file(path, self.directory)
+            self.assertEqual(list(expected.times), list(timecodes.times))
+            self.assertEqual(expected.default_fps, timecodes.default_fps)
+            self.assertEqual(expected.get_frame_number(30), timecodes.get_frame_number(30))
+            self.assertEqual(expected.get_frame_time(100), timecodes.get_frame_time(100))
+
+    def test_keyframes(self):
+        path = self.write("kf.txt", "# XviD 2pass stat file\n\n\np\ni\np\ni\n")
+        self.assertEqual([0, 1, 3], list(tools.parse_keyframes(path, self.directory)))
+        self.assertEqual([0, 1, 3], list(tools.parse_keyframes(path, self.directory)))
+        self.assertEqual(1, len([x for x in os.listdir(self.directory) if x.endswith(".keyframes")]))
+
+
+class TestSorting(unittest.TestCase):
+    def test_is_sorted(self):
+        self.assertTrue(tools.is_sorted([1, 2, 2, 3], key=lambda x: x))
+        self.assertFalse(tools.is_sorted([1, 3, 2], key=lambda x: x))
+        self.assertTrue(tools.is_sorted([3, 2, 2, 1], key=lambda x: x, descending=True))
+
+    def test_merge_sorted(self):
+        merged = tools.merge_sorted([[(1, 'a'), (3, 'a')], [(1, 'b'), (2, 'b')], []], key=lambda x: x[0])
+        self.assertEqual([(1, 'a'), (1, 'b'), (2, 'b'), (3, 'a')], list(merged))
+
+    def test_merge_sorted_descending(self):
+        merged = tools.merge_sorted([[(3, 'a'), (1, 'a')], [(3, 'b'), (2, 'b')]], key=lambda x: x[0], descending=True)
+        self.assertEqual([(3, 'a'), (3, 'b'), (2, 'b'), (1, 'a')], list(merged))
+
+
+class TestIntervalIndex(unittest.TestCase):
+    intervals = [(0, 10), (2, 3), (5, 15), (5, 5), (12, 20), (30, 40), (35, 36)]
+
+    def build(self):
+        return tools.IntervalIndex(self.intervals, lambda x: x[0], lambda x: x[1])
+
+    def test_overlapping(self):
+        index = self.build()
+        for low, high in ((0, 1), (3, 5), (10, 12), (15, 30), (20, 30), (0, 100), (36, 37)):
+            expected = [x for x in sorted(self.intervals, key=lambda x: x[0]) if x[0] < high and x[1] > low]
+            self.assertEqual(expected, index.overlapping(low, high))
+
+    def test_active_at(self):
+        index = self.build()
+        self.assertEqual([(0, 10), (2, 3)], index.active_at(2))
+        self.assertEqual([(0, 10), (5, 15)], index.active_at(5))
+        self.assertEqual([], index.active_at(20))
+        self.assertEqual([(30, 40), (35, 36)], index.active_at(35))
+
+    def test_overlapping_pairs(self):
+        pairs = self.build().overlapping_pairs()
+        # (5, 5) is empty and intersects with nothing
+        self.assertEqual([((0, 10), (2, 3)), ((0, 10), (5, 15)),
+                          ((5, 15), (12, 20)), ((30, 40), (35, 36))], pairs)
+
+    def test_overlapping_pairs_grouped(self):
+        pairs = self.build().overlapping_pairs(group_key=lambda x: x[0] % 2)
+        self.assertEqual([((0, 10), (2, 3))], pairs)
@@ -1,13 +1,70 @@
 from common import PrassError
+import array
 import bisect
+import hashlib
+import heapq
 import math
+import mmap
+import os
+import struct
+import tempfile
+
+ARRAY_CACHE_MAGIC = b"PRASSARR"
+ARRAY_CACHE_HEADER_SIZE = 16
+
+
+def hash_file(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as file_object:
+        for block in iter(lambda: file_object.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
 
 
 def parse_scxvid_keyframes(text):
     return [i-3 for i,line in enumerate(text.splitlines()) if line and line[0] == 'i']
 
 
-def parse_keyframes(path):
+def _write_array_cache(path, values, typecode, default_fps):
+    data = array.array(typecode, values)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as cache:
+        cache.write(ARRAY_CACHE_MAGIC)
+        cache.write(struct.pack('<d', default_fps or 0))
+        cache.write(data.tobytes() if hasattr(data, 'tobytes') else data.tostring())
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # another process has written the same cache first
+        os.remove(temp_path)
+
+
+def _map_array_cache(path, typecode):
+    with open(path, 'rb') as cache:
+        mapped = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(ARRAY_CACHE_MAGIC)] != ARRAY_CACHE_MAGIC:
+        raise PrassError('Cache file {0} is corrupted'.format(path))
+    default_fps = struct.unpack('<d', mapped[len(ARRAY_CACHE_MAGIC):ARRAY_CACHE_HEADER_SIZE])[0] or None
+    if not hasattr(memoryview, 'cast'):
+        # python 2 can't make memoryviews of mmap or reinterpret buffers, so it gets a private copy
+        return array.array(typecode, mapped[ARRAY_CACHE_HEADER_SIZE:]), default_fps
+    return memoryview(mapped)[ARRAY_CACHE_HEADER_SIZE:].cast(typecode), default_fps
+
+
+def load_array_cache(source_path, cache_dir, name, typecode, loader):
+    """Memory-map an array parsed from source_path, writing the binary cache on first use.
+    All processes using the same cache directory share a single copy of the array in memory.
+    loader gets the source path and returns (values, default_fps)."""
+    path = os.path.join(cache_dir, '{0}.{1}'.format(hash_file(source_path), name))
+    if not os.path.isfile(path):
+        values, default_fps = loader(source_path)
+        _write_array_cache(path, values, typecode, default_fps)
+    return _map_array_cache(path, typecode)
+
+
+def parse_keyframes(path, cache_dir=None):
+    if cache_dir:
+        return load_array_cache(path, cache_dir, 'keyframes', 'i', lambda x: (parse_keyframes(x), None))[0]
     with open(path) as file_object:
         text = file_object.read()
     if text.find('# XviD 2pass stat file')>=0:
@@ -26,6 +83,7 @@ class Timecodes(object):
     def __init__(self, times, default_fps):
         super(Timecodes, self).__init__()
         self.times = times
+        self.default_fps = default_fps
         self.default_frame_duration = 1000.0 / default_fps if default_fps else None
 
     def get_frame_time(self, number, kind=None):
@@ -38,16 +96,23 @@ class Timecodes(object):
             after = self.get_frame_time(number+1)
             return curr + int(round((after - curr) / 2.0))
 
-        try:
-            return self.times[number]
-        except IndexError:
-            if not self.default_frame_duration:
-                raise ValueError("Cannot calculate frame timestamp without frame duration")
-            past_end, last_time = number, 0
-            if self.times:
-                past_end, last_time = (number - len(self.times) + 1), self.times[-1]
+        times = self.times
+        if 0 <= number < len(times):
+            return times[number]
+        if number < 0:
+            return int(round((times[0] if times else 0) + number * self._outer_frame_duration(False)))
+        past_end, last_time = number, 0
+        if times:
+            past_end, last_time = (number - len(times) + 1), times[-1]
+        return int(round(past_end * self._outer_frame_duration(True) + last_time))
 
-            return int(round(past_end * self.default_frame_duration + last_time))
+    def _outer_frame_duration(self, after_end):
+        """Duration of frames outside of the timecodes: the default one or the closest frame interval"""
+        if self.default_frame_duration:
+            return self.default_frame_duration
+        if len(self.times) > 1:
+            return self.times[-1] - self.times[-2] if after_end else self.times[1] - self.times[0]
+        raise ValueError("Cannot calculate frames outside of the timecodes without frame duration")
 
     def get_frame_number(self, ms, kind=None):
         if kind == self.TIMESTAMP_START:
@@ -55,17 +120,72 @@ class Timecodes(object):
         elif kind == self.TIMESTAMP_END:
             return self.get_frame_number(ms - 1)
 
-        if self.times and self.times[-1] >= ms:
-            return bisect.bisect_left(self.times, ms)
+        # a frame is displayed from its own timestamp until the next one
+        times = self.times
+        if times and times[0] <= ms <= times[-1]:
+            return bisect.bisect_right(times, ms) - 1
+        if not times:
+            return int(math.floor(ms / self._outer_frame_duration(True)))
+        if ms < times[0]:
+            return int(math.floor((ms - times[0]) / self._outer_frame_duration(False)))
+        return int((ms - times[-1]) / self._outer_frame_duration(True)) + len(times) - 1
 
-        if not self.default_frame_duration:
-            raise ValueError("Cannot calculate frame for this timestamp without frame duration")
+    def get_frame_numbers(self, values, kind=None):
+        """Same as calling get_frame_number for every value. Without timecodes frames are computed directly,
+        otherwise values are visited in sorted order so frames inside the timecodes are found
+        by a single walk over times instead of a binary search each"""
+        if kind == self.TIMESTAMP_START:
+            return [x + 1 for x in self.get_frame_numbers([v - 1 for v in values])]
+        elif kind == self.TIMESTAMP_END:
+            return self.get_frame_numbers([v - 1 for v in values])
+
+        times = self.times
+        if not times:
+            duration = self._outer_frame_duration(True)
+            return [int(math.floor(ms / duration)) for ms in values]
+
+        first, last, count = times[0], times[-1], len(times)
+        result = [None] * len(values)
+        position = 0
+        for idx in sorted(range(len(values)), key=values.__getitem__):
+            ms = values[idx]
+            if ms < first:
+                result[idx] = int(math.floor((ms - first) / self._outer_frame_duration(False)))
+            elif ms > last:
+                result[idx] = int((ms - last) / self._outer_frame_duration(True)) + count - 1
+            else:
+                while position + 1 < count and times[position + 1] <= ms:
+                    position += 1
+                result[idx] = position
+        return result
 
-        if ms < 0:
-            return int(math.floor(ms / self.default_frame_duration))
+    def get_frame_times(self, numbers, kind=None):
+        """Same as calling get_frame_time for every number, in a single pass over the list"""
+        if kind == self.TIMESTAMP_START:
+            return self.frame_boundaries(self.get_frame_times([x - 1 for x in numbers]), self.get_frame_times(numbers))
+        elif kind == self.TIMESTAMP_END:
+            return self.frame_boundaries(self.get_frame_times(numbers), self.get_frame_times([x + 1 for x in numbers]))
 
-        last_time = self.times[-1] if self.times else 0
-        return int((ms - last_time) / self.default_frame_duration) + len(self.times)
+        times = self.times
+        if not times:
+            duration = self._outer_frame_duration(True)
+            return [int(round(number * duration)) for number in numbers]
+
+        count = len(times)
+        result = []
+        for number in numbers:
+            if 0 <= number < count:
+                result.append(times[number])
+            elif number < 0:
+                result.append(int(round(times[0] + number * self._outer_frame_duration(False))))
+            else:
+                result.append(int(round((number - count + 1) * self._outer_frame_duration(True) + times[-1])))
+        return result
+
+    @staticmethod
+    def frame_boundaries(earlier_times, later_times):
+        """Times in the middle between timestamps of consecutive frames, as used for TIMESTAMP_START and END"""
+        return [earlier + int(round((later - earlier) / 2.0)) for earlier, later in zip(earlier_times, later_times)]
 
     @classmethod
     def _convert_v1_to_v2(cls, default_fps, overrides):
@@ -75,8 +195,8 @@ class Timecodes(object):
             return []
 
         fps = [default_fps] * (overrides[-1][1] + 1)
-        for start, end, fps in overrides:
-            fps[start:end + 1] = [fps] * (end - start + 1)
+        for start, end, override in overrides:
+            fps[start:end + 1] = [override] * (end - start + 1)
 
         v2 = [0]
         for d in (1000.0 / f for f in fps):
@@ -90,7 +210,7 @@ class Timecodes(object):
             return []
         first = lines[0].lower().lstrip()
         if first.startswith('# timecode format v2'):
-            tcs = [x for x in lines[1:]]
+            tcs = [float(x) for x in lines[1:] if x.strip() and not x.startswith('#')]
             return Timecodes(tcs, None)
         elif first.startswith('# timecode format v1'):
             default = float(lines[1].lower().replace('assume ', ""))
@@ -100,10 +220,137 @@ class Timecodes(object):
             raise PrassError('This timecodes format is not supported')
 
     @classmethod
-    def from_file(cls, path):
+    def _load_for_cache(cls, path):
+        timecodes = cls.from_file(path)
+        return timecodes.times, timecodes.default_fps
+
+    @classmethod
+    def from_file(cls, path, cache_dir=None):
+        if cache_dir:
+            return Timecodes(*load_array_cache(path, cache_dir, 'timecodes', 'd', cls._load_for_cache))
         with open(path) as file:
             return cls.parse(file.read())
 
     @classmethod
     def cfr(cls, fps):
         return Timecodes([], default_fps=fps)
+
+
+class _ReversedKey(object):
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def is_sorted(items, key, descending=False):
+    previous = None
+    for idx, item in enumerate(items):
+        current = key(item)
+        if idx and ((current > previous) if descending else (current < previous)):
+            return False
+        previous = current
+    return True
+
+
+def merge_sorted(iterables, key, descending=False):
+    # stable k-way merge: ties are resolved by the position of the source in iterables
+    wrap = _ReversedKey if descending else (lambda x: x)
+    heap = []
+    for idx, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heap.append((wrap(key(item)), idx, item, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, idx, item, iterator = heap[0]
+        yield item
+        for item in iterator:
+            heapq.heapreplace(heap, (wrap(key(item)), idx, item, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class IntervalIndex(object):
+    """Static interval tree over half-open [start, end) intervals.
+    Items are kept in an implicit balanced tree over the start-sorted array, every node remembers
+    the maximum end of its subtree so queries only visit subtrees that can contain matches."""
+    def __init__(self, items, start_getter, end_getter):
+        super(IntervalIndex, self).__init__()
+        self._start_getter = start_getter
+        self._end_getter = end_getter
+        self.items = sorted(items, key=start_getter)
+        self._starts = [start_getter(x) for x in self.items]
+        self._ends = [end_getter(x) for x in self.items]
+        self._max_ends = list(self._ends)
+        if self.items:
+            self._build(0, len(self.items))
+
+    def _build(self, lo, hi):
+        mid = (lo + hi) // 2
+        max_end = self._ends[mid]
+        if lo < mid:
+            max_end = max(max_end, self._build(lo, mid))
+        if mid + 1 < hi:
+            max_end = max(max_end, self._build(mid + 1, hi))
+        self._max_ends[mid] = max_end
+        return max_end
+
+    def __len__(self):
+        return len(self.items)
+
+    def _query(self, low, high, include_high):
+        result = []
+        stack = [(0, len(self.items))] if self.items else []
+        while stack:
+            lo, hi = stack.pop()
+            mid = (lo + hi) // 2
+            if self._max_ends[mid] <= low:
+                continue
+            start = self._starts[mid]
+            starts_before = start <= high if include_high else start < high
+            if mid + 1 < hi and starts_before:
+                stack.append((mid + 1, hi))
+            if starts_before and self._ends[mid] > low:
+                result.append(mid)
+            if lo < mid:
+                stack.append((lo, mid))
+        return [self.items[idx] for idx in sorted(result)]
+
+    def overlapping(self, start, end):
+        """Items intersecting with [start, end), in start order"""
+        return self._query(start, end, False)
+
+    def active_at(self, time):
+        """Items with start <= time < end, in start order"""
+        return self._query(time, time, True)
+
+    def overlapping_pairs(self, group_key=None):
+        """All pairs of items with a non-empty intersection, optionally only within groups defined by group_key.
+        Runs a sweep line over start-sorted items, so it takes O(n log n + k) time."""
+        groups = {}
+        for item in self.items:
+            groups.setdefault(group_key(item) if group_key else None, []).append(item)
+
+        pairs = []
+        for group in groups.values():
+            active = []
+            for idx, item in enumerate(group):
+                start, end = self._start_getter(item), self._end_getter(item)
+                if end <= start:
+                    # empty items don't intersect with anything
+                    continue
+                while active and active[0][0] <= start:
+                    heapq.heappop(active)
+                pairs.extend((group[other], item) for other_end, other in active)
+                heapq.heappush(active, (end, idx))
+        pairs.sort(key=lambda pair: (self._start_getter(pair[0]), self._start_getter(pair[1])))
+        return pairs